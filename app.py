@@ -1,408 +1,101 @@
 import streamlit as st
-import openpyxl
-from io import BytesIO
-from zipfile import ZipFile, ZIP_DEFLATED
-import xml.etree.ElementTree as ET
-import re
-from datetime import datetime, time, date
-from copy import copy
-import unicodedata
-
-SPREADSHEET_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
-ET.register_namespace('', SPREADSHEET_NS)
-ET.register_namespace('r', 'http://schemas.openxmlformats.org/officeDocument/2006/relationships')
-ET.register_namespace('mc', 'http://schemas.openxmlformats.org/markup-compatibility/2006')
-ET.register_namespace('x14ac', 'http://schemas.microsoft.com/office/spreadsheetml/2009/9/ac')
-ET.register_namespace('xr', 'http://schemas.microsoft.com/office/spreadsheetml/2014/revision')
-ET.register_namespace('xr2', 'http://schemas.microsoft.com/office/spreadsheetml/2015/revision2')
-ET.register_namespace('xr3', 'http://schemas.microsoft.com/office/spreadsheetml/2016/revision3')
-ET.register_namespace('xr6', 'http://schemas.microsoft.com/office/spreadsheetml/2014/revision6')
-ET.register_namespace('xr10', 'http://schemas.microsoft.com/office/spreadsheetml/2018/revision10')
-
-ZONA_DEFAULT = "(UTC+01:00) Bruselas, Copenhague, Madrid, París"
-SOBRESCRITURA_DEFAULT = "Sí"
-TEMPLATE_SHEET = "Registros de jornada"
-HEADER_ROW = 1
+import pandas as pd
+import cProfile
+import threading
+from datetime import datetime, time
+from functools import partial
 
+from endalia import (
+    CacheCompartida, DELTA_ORIGENES, DIRECTORIO_DB, GeneracionCancelada, PARTICIONES, Progreso,
+    TRAMOS_FORMATOS, content_hash, extract_date_part, fmt_date, fmt_time, generacion_en_curso,
+    generar_plantilla, horas_hash, huellas_de_salida, leer_salida, match_candidates, medir_etapa,
+    normalize_id, normalize_name, parse_directorio_persistente, parse_tramos_pendientes, perfil_a_bytes,
+    prepare_template, regenerar_plantilla, resumen_perfil, save_alias, save_huellas, tamano_entrada,
+    tamano_resultado,
+)
 
-# ═══════════════════════════════════════════════════
-# XML / ZIP — Preservar validaciones
-# ═══════════════════════════════════════════════════
+SALIDA_TTL_SECONDS = 10 * 60
+EDITOR_PAGE_SIZE = 100
+RESULTADO_PAGE_SIZE = 200
 
-def extract_all_validations(file_bytes):
-    validations = {}
-    ns = '{' + SPREADSHEET_NS + '}'
-    with ZipFile(BytesIO(file_bytes), 'r') as zf:
-        for name in zf.namelist():
-            if name.startswith('xl/worksheets/') and name.endswith('.xml'):
-                tree = ET.fromstring(zf.read(name))
-                dv_node = tree.find(ns + 'dataValidations')
-                if dv_node is not None:
-                    validations[name] = ET.tostring(dv_node, encoding='unicode')
-    return validations
-
-
-def expand_sqref(sqref, max_row):
-    parts = sqref.split(' ')
-    new_parts = []
-    for part in parts:
-        if ':' in part:
-            start, end = part.split(':')
-            col_end = re.match(r'([A-Z]+)', end)
-            row_end = re.search(r'(\d+)', end)
-            if col_end and row_end:
-                old_row = int(row_end.group(1))
-                if max_row > old_row:
-                    new_parts.append(f"{start}:{col_end.group(1)}{max_row}")
-                else:
-                    new_parts.append(part)
-            else:
-                new_parts.append(part)
-        else:
-            new_parts.append(part)
-    return ' '.join(new_parts)
-
-
-def patch_zip_with_validations(output_bytes, original_bytes):
-    ns = '{' + SPREADSHEET_NS + '}'
-    original_zip = ZipFile(BytesIO(original_bytes), 'r')
-    output_zip_in = ZipFile(BytesIO(output_bytes), 'r')
-    original_sheets = {}
-    for name in original_zip.namelist():
-        if name.startswith('xl/worksheets/') and name.endswith('.xml'):
-            original_sheets[name] = original_zip.read(name)
-    result_buffer = BytesIO()
-    result_zip = ZipFile(result_buffer, 'w', ZIP_DEFLATED)
-    processed = set()
-    for item in output_zip_in.namelist():
-        data = output_zip_in.read(item)
-        processed.add(item)
-        if item in original_sheets:
-            try:
-                output_tree = ET.fromstring(data)
-                original_tree = ET.fromstring(original_sheets[item])
-                for dv in output_tree.findall(ns + 'dataValidations'):
-                    output_tree.remove(dv)
-                original_dv = original_tree.find(ns + 'dataValidations')
-                if original_dv is not None:
-                    output_sd = output_tree.find(ns + 'sheetData')
-                    if output_sd is not None:
-                        all_rows = output_sd.findall(ns + 'row')
-                        if all_rows:
-                            max_row = max(int(r.get('r', '1')) for r in all_rows)
-                            for dv_item in original_dv.findall(ns + 'dataValidation'):
-                                sqref = dv_item.get('sqref', '')
-                                dv_item.set('sqref', expand_sqref(sqref, max_row))
-                    insert_before = [
-                        ns + 'pageMargins', ns + 'pageSetup', ns + 'headerFooter',
-                        ns + 'drawing', ns + 'legacyDrawing', ns + 'tableParts', ns + 'extLst',
-                    ]
-                    inserted = False
-                    for tag in insert_before:
-                        target = output_tree.find(tag)
-                        if target is not None:
-                            idx = list(output_tree).index(target)
-                            output_tree.insert(idx, original_dv)
-                            inserted = True
-                            break
-                    if not inserted:
-                        output_tree.append(original_dv)
-                original_ext = original_tree.find(ns + 'extLst')
-                if original_ext is not None:
-                    for ext in output_tree.findall(ns + 'extLst'):
-                        output_tree.remove(ext)
-                    output_tree.append(original_ext)
-                data = b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
-                data += ET.tostring(output_tree, encoding='unicode').encode('utf-8')
-            except ET.ParseError:
-                pass
-        result_zip.writestr(item, data)
-    for item in original_zip.namelist():
-        if item not in processed:
-            result_zip.writestr(item, original_zip.read(item))
-    original_zip.close()
-    output_zip_in.close()
-    result_zip.close()
-    return result_buffer.getvalue()
 
+@st.cache_resource
+def cache_compartida():
+    return CacheCompartida()
 
-# ═══════════════════════════════════════════════════
-# Utilidades
-# ═══════════════════════════════════════════════════
 
-def remove_accents(text):
-    nfkd = unicodedata.normalize('NFKD', text)
-    return ''.join(c for c in nfkd if not unicodedata.category(c).startswith('M'))
-
-
-def normalize_name(name):
-    if name is None:
-        return ''
-    s = str(name).strip().lower()
-    s = remove_accents(s)
-    s = re.sub(r'\s+', ' ', s).strip()
-    return s
-
-
-def extract_time_part(val):
-    if val is None:
-        return None
-    if isinstance(val, time):
-        return val
-    if isinstance(val, datetime):
-        return val.time()
-    s = str(val).strip()
-    m = re.match(r'(\d{1,2}):(\d{2})', s)
-    if m:
-        return time(int(m.group(1)), int(m.group(2)))
-    return None
-
-
-def extract_date_part(val):
-    if val is None:
-        return None
-    if isinstance(val, datetime):
-        return val.date()
-    if isinstance(val, date):
-        return val
-    s = str(val).strip()
-    for fmt in ['%d/%m/%Y', '%Y-%m-%d', '%d-%m-%Y']:
-        try:
-            return datetime.strptime(s, fmt).date()
-        except ValueError:
-            continue
-    return None
-
-
-def combine_date_time(fecha_val, hora_val):
-    d = extract_date_part(fecha_val)
-    t = extract_time_part(hora_val)
-    if d is None or t is None:
-        return None
-    return datetime.combine(d, t)
-
-
-def fmt_time(val):
-    if val is None:
-        return ''
-    if isinstance(val, time):
-        return val.strftime('%H:%M')
-    if isinstance(val, datetime):
-        return val.strftime('%H:%M')
-    return str(val)
-
-
-def fmt_date(val):
-    if val is None:
-        return ''
-    if isinstance(val, (datetime, date)):
-        return val.strftime('%d/%m/%Y')
-    return str(val)
-
-
-def is_missing_hora_fin(hora_fin):
-    if hora_fin is None:
-        return True
-    if isinstance(hora_fin, time):
-        return hora_fin == time(0, 0)
-    if isinstance(hora_fin, datetime):
-        return hora_fin.hour == 0 and hora_fin.minute == 0
-    s = str(hora_fin).strip()
-    return s == '' or s in ('00:00', '0:00', '00:00:00')
-
-
-def read_tramos(wb):
-    ws = wb.active
-    col_map = {}
-    keywords = {
-        'fecha': ['fecha'],
-        'hora_inicio': ['hora inicio'],
-        'hora_fin': ['hora fin'],
-        'tipo_tramo': ['tipo de tramo', 'tipo de tra', 'tipo tramo'],
-        'empleado': ['empleado'],
-    }
-    for col in range(1, ws.max_column + 1):
-        val = ws.cell(row=1, column=col).value
-        if val is None:
-            continue
-        val_lower = str(val).strip().lower()
-        for key, terms in keywords.items():
-            for term in terms:
-                if term in val_lower and key not in col_map:
-                    col_map[key] = col
-                    break
-    if 'empleado' not in col_map:
-        return None, "No se encontró la columna 'Empleado' en el archivo de registros."
-    tramos = []
-    for row in range(2, ws.max_row + 1):
-        emp = ws.cell(row=row, column=col_map['empleado']).value
-        if emp is None or str(emp).strip() == '':
-            continue
-        tramo = {'empleado': str(emp).strip()}
-        for key in ['fecha', 'hora_inicio', 'hora_fin', 'tipo_tramo']:
-            if key in col_map:
-                tramo[key] = ws.cell(row=row, column=col_map[key]).value
-        tramos.append(tramo)
-    return tramos, None
-
-
-def find_plantilla_columns(ws):
-    cols = {}
-    for col in range(1, ws.max_column + 1):
-        val = ws.cell(row=HEADER_ROW, column=col).value
-        if val is None:
-            continue
-        h = str(val).strip().lower()
-        if 'doc. identificador' in h or h == 'nif' or h == 'dni':
-            cols.setdefault('nif', col)
-        elif 'codigo empleado' in h or 'código empleado' in h:
-            cols.setdefault('codigo', col)
-        elif h == 'empleado':
-            cols.setdefault('empleado', col)
-        elif 'fecha de referencia' in h:
-            cols.setdefault('fecha_ref', col)
-        elif 'zona horaria' in h:
-            cols.setdefault('zona', col)
-        elif h == 'inicio':
-            cols.setdefault('inicio', col)
-        elif h == 'fin':
-            cols.setdefault('fin', col)
-        elif 'tipo de tramo' in h:
-            cols.setdefault('tipo_tramo', col)
-        elif 'sobrescritura' in h:
-            cols.setdefault('sobrescritura', col)
-    return cols
-
-
-def copy_cell_style(src, tgt):
-    if src.has_style:
-        tgt.font = copy(src.font)
-        tgt.border = copy(src.border)
-        tgt.fill = copy(src.fill)
-        tgt.number_format = src.number_format
-        tgt.protection = copy(src.protection)
-        tgt.alignment = copy(src.alignment)
+def cached_parse(kind, data, parser):
+    # Las entradas se indexan por el hash del contenido subido: los reruns que solo
+    # cambian widgets, y las demás sesiones con los mismos archivos, no vuelven a parsear
+    return cache_compartida().obtener_o_calcular((kind, content_hash(data)), partial(parser, data),
+                                                 partial(tamano_entrada, kind))
 
 
 # ═══════════════════════════════════════════════════
-# Motor de conciliación
+# INTERFAZ
 # ═══════════════════════════════════════════════════
 
-def conciliar(wb_template, tramos):
-    if TEMPLATE_SHEET in wb_template.sheetnames:
-        ws = wb_template[TEMPLATE_SHEET]
-    else:
-        ws = wb_template.active
-
-    cols = find_plantilla_columns(ws)
-    if 'empleado' not in cols:
-        return None, None, None, "No se encontró la columna 'Empleado' en la plantilla."
-
-    plantilla_emps = []
-    for row in range(HEADER_ROW + 1, ws.max_row + 1):
-        emp_val = ws.cell(row=row, column=cols['empleado']).value
-        if emp_val is None or str(emp_val).strip() == '':
-            continue
-        plantilla_emps.append({
-            'nombre': str(emp_val).strip(),
-            'nombre_norm': normalize_name(emp_val),
-            'nif': ws.cell(row=row, column=cols.get('nif', 1)).value,
-            'codigo': ws.cell(row=row, column=cols.get('codigo', 2)).value,
-        })
-
-    plantilla_index = {pe['nombre_norm']: pe for pe in plantilla_emps}
-
-    tramos_by_emp = {}
-    for t in tramos:
-        key = normalize_name(t['empleado'])
-        if key not in tramos_by_emp:
-            tramos_by_emp[key] = []
-        tramos_by_emp[key].append(t)
-
-    output_rows = []
-    matched_norms = set()
-    unmatched = []
-
-    for tramo_norm, emp_tramos in tramos_by_emp.items():
-        found = plantilla_index.get(tramo_norm)
-        if found is None:
-            for pe_norm, pe in plantilla_index.items():
-                if tramo_norm in pe_norm or pe_norm in tramo_norm:
-                    found = pe
-                    break
-        if found is None:
-            for t in emp_tramos:
-                unmatched.append(t['empleado'])
-            continue
-
-        matched_norms.add(found['nombre_norm'])
-        for t in emp_tramos:
-            fecha_ref = t.get('fecha')
-            output_rows.append({
-                'nif': found['nif'],
-                'codigo': found['codigo'],
-                'nombre': found['nombre'],
-                'fecha_ref': extract_date_part(fecha_ref),
-                'zona': ZONA_DEFAULT,
-                'inicio': combine_date_time(fecha_ref, t.get('hora_inicio')),
-                'fin': combine_date_time(fecha_ref, t.get('hora_fin')),
-                'tipo_tramo': t.get('tipo_tramo'),
-                'sobrescritura': SOBRESCRITURA_DEFAULT,
-            })
-
-    removed = sum(1 for pe in plantilla_emps if pe['nombre_norm'] not in matched_norms)
-
-    style_row = HEADER_ROW + 1
-    styles = {}
-    max_col = ws.max_column
-    for c in range(1, max_col + 1):
-        styles[c] = ws.cell(row=style_row, column=c)
-
-    for row in range(HEADER_ROW + 1, ws.max_row + 1):
-        for c in range(1, max_col + 1):
-            ws.cell(row=row, column=c).value = None
-
-    for i, item in enumerate(output_rows):
-        row = HEADER_ROW + 1 + i
-        for c in range(1, max_col + 1):
-            copy_cell_style(styles[c], ws.cell(row=row, column=c))
-        if 'nif' in cols:
-            ws.cell(row=row, column=cols['nif']).value = item['nif']
-        if 'codigo' in cols:
-            ws.cell(row=row, column=cols['codigo']).value = item['codigo']
-        if 'empleado' in cols:
-            ws.cell(row=row, column=cols['empleado']).value = item['nombre']
-        if 'fecha_ref' in cols:
-            cell = ws.cell(row=row, column=cols['fecha_ref'])
-            cell.value = item['fecha_ref']
-            cell.number_format = 'DD/MM/YYYY'
-        if 'zona' in cols:
-            ws.cell(row=row, column=cols['zona']).value = item['zona']
-        if 'inicio' in cols:
-            cell = ws.cell(row=row, column=cols['inicio'])
-            cell.value = item['inicio']
-            cell.number_format = 'DD/MM/YYYY HH:MM'
-        if 'fin' in cols:
-            cell = ws.cell(row=row, column=cols['fin'])
-            cell.value = item['fin']
-            cell.number_format = 'DD/MM/YYYY HH:MM'
-        if 'tipo_tramo' in cols:
-            ws.cell(row=row, column=cols['tipo_tramo']).value = item['tipo_tramo']
-        if 'sobrescritura' in cols:
-            ws.cell(row=row, column=cols['sobrescritura']).value = item['sobrescritura']
-
-    return output_rows, list(set(unmatched)), removed, None
+def build_pendientes_table(tramos_sin_fin):
+    # Tabla compacta que respalda el editor: una fila por tramo pendiente,
+    # con el mismo índice que `st.session_state.horas_fin`
+    return pd.DataFrame({
+        'Empleado': [t.empleado for t in tramos_sin_fin],
+        'Fecha': [fmt_date(t.fecha) for t in tramos_sin_fin],
+        'Inicio': [fmt_time(t.hora_inicio) for t in tramos_sin_fin],
+        'dia': pd.to_datetime([extract_date_part(t.fecha) for t in tramos_sin_fin]),
+    })
 
 
-# ═══════════════════════════════════════════════════
-# INTERFAZ
-# ═══════════════════════════════════════════════════
+def parse_tramos_editor(tramos_bytes):
+    parsed, error = parse_tramos_pendientes(tramos_bytes)
+    if error:
+        return None, error
+    return dict(parsed, tabla=build_pendientes_table(parsed['pendientes'])), None
+
+
+def resumir_resultado(res):
+    # Vista previa y agregados de una generación, calculados una sola vez: la
+    # tabla es columnar y sin formatear (fechas y horas como datetime64), y en
+    # cada rerun solo se envía al navegador la página visible
+    rows = res['rows']
+    inicio = pd.to_datetime([r.inicio for r in rows])
+    fin = pd.to_datetime([r.fin for r in rows])
+    tabla = pd.DataFrame({
+        'Empleado': pd.array([r.nombre for r in rows], dtype='string'),
+        'NIF': pd.array([r.nif for r in rows], dtype='string'),
+        'Fecha': pd.to_datetime([r.fecha_ref for r in rows]),
+        'Inicio': inicio,
+        'Fin': fin,
+        'Horas': (fin - inicio) / pd.Timedelta(hours=1),
+        'Tipo de tramo': pd.array([r.tipo_tramo for r in rows], dtype='string'),
+    })
+    por_empleado = (tabla.groupby(['Empleado', 'NIF'], dropna=False)
+                    .agg(Tramos=('Horas', 'size'), Horas=('Horas', 'sum'))
+                    .reset_index())
+    por_dia = (tabla.groupby('Fecha')
+               .agg(Tramos=('Horas', 'size'), Empleados=('Empleado', 'nunique'), Horas=('Horas', 'sum'))
+               .reset_index())
+    return {
+        'tabla': tabla,
+        'por_empleado': por_empleado,
+        'por_dia': por_dia,
+        'horas': float(tabla['Horas'].sum()),
+        'no_encontrados': len(res['unmatched']),
+        'sin_tramos': res['removed'],
+    }
+
 
 def init_state():
     if 'horas_fin' not in st.session_state:
         st.session_state.horas_fin = {}
     if 'resultado' not in st.session_state:
         st.session_state.resultado = None
+    if 'editor_version' not in st.session_state:
+        st.session_state.editor_version = 0
+    if 'trabajo' not in st.session_state:
+        st.session_state.trabajo = None
+    if 'error_generacion' not in st.session_state:
+        st.session_state.error_generacion = None
 
 
 def apply_mass_hora(indices, hora):
@@ -410,6 +103,131 @@ def apply_mass_hora(indices, hora):
         st.session_state.horas_fin[i] = hora
 
 
+ETAPAS_PROGRESO = {
+    'fechas': "Interpretando fechas y horas",
+    'conciliar': "Conciliando tramos con la plantilla",
+    'validar': "Buscando solapes y duplicados",
+    'escritura': "Escribiendo filas",
+    'comprimir': "Comprimiendo",
+    'partes': "Generando plantillas",
+    'guardar': "Guardando el libro",
+    'patch_zip': "Restaurando validaciones",
+}
+GENERACION_POLL_SECONDS = 0.5
+
+
+def lanzar_generacion(tarea, perfilar=False, trazar=False):
+    # `tarea(progreso, metricas)` corre en un hilo aparte para que la sesión no se
+    # quede bloqueada; panel_generacion sigue el avance y recoge el resultado.
+    # Hilo y no proceso: las funciones del script no se pueden enviar a otro proceso
+    trabajo = {'progreso': Progreso(), 'metricas': [], 'resultado': None, 'error': None, 'perfil': None,
+               'hecho': threading.Event()}
+
+    def ejecutar():
+        perfil = cProfile.Profile() if perfilar else None
+        if perfil is not None:
+            perfil.enable()
+        try:
+            with generacion_en_curso(trazar):
+                trabajo['resultado'], trabajo['error'] = tarea(trabajo['progreso'], trabajo['metricas'])
+        except GeneracionCancelada:
+            trabajo['error'] = "Generación cancelada."
+        except Exception as e:
+            trabajo['error'] = f"Ha ocurrido un error: {str(e)}"
+        finally:
+            if perfil is not None:
+                perfil.disable()
+                trabajo['perfil'] = perfil
+            trabajo['hecho'].set()
+
+    threading.Thread(target=ejecutar, name='generar_plantilla', daemon=True).start()
+    return trabajo
+
+
+def recoger_generacion(trabajo):
+    if trabajo['error']:
+        st.session_state.error_generacion = trabajo['error']
+        return
+    # El resultado puede estar en la caché compartida: se copia, no se modifica
+    perfil = trabajo['perfil']
+    st.session_state.resultado = dict(
+        trabajo['resultado'],
+        metricas=trabajo['metricas'],
+        perfil=perfil_a_bytes(perfil) if perfil is not None else None,
+        perfil_resumen=resumen_perfil(perfil) if perfil is not None else None,
+    )
+
+
+@st.fragment(run_every=GENERACION_POLL_SECONDS)
+def panel_generacion():
+    trabajo = st.session_state.trabajo
+    if trabajo is None:
+        return
+    if trabajo['hecho'].is_set():
+        st.session_state.trabajo = None
+        recoger_generacion(trabajo)
+        st.rerun(scope='app')
+    progreso = trabajo['progreso']
+    texto = ETAPAS_PROGRESO.get(progreso.etapa, "Preparando...")
+    if progreso.total:
+        texto += f" · {progreso.hechas:,} de {progreso.total:,}".replace(',', '.')
+    st.progress(min(progreso.hechas / progreso.total, 1.0) if progreso.total else 0.0, text=texto)
+    if progreso.cancelado:
+        st.caption("Cancelando...")
+    elif st.button("Cancelar", key='cancelar_generacion', width='stretch'):
+        progreso.cancelar()
+
+
+ALIAS_CANDIDATOS = 10
+ALIAS_MIN_SCORE = 0.2
+
+
+def buscar_empleados(directorio, texto):
+    # NIF o código exactos; si no, los nombres más parecidos
+    clave = normalize_id(texto)
+    exacto = directorio['por_nif'].get(clave) or directorio['por_codigo'].get(clave)
+    if exacto is not None:
+        return [exacto]
+    return [pe for _, pe in match_candidates(directorio, normalize_name(texto), limit=ALIAS_CANDIDATOS,
+                                             min_score=ALIAS_MIN_SCORE)]
+
+
+def render_alias_form(unmatched, plantilla_bytes, propuestas=None):
+    # `propuestas`: {nombre: empleado de la plantilla} que se parece pero no se ha
+    # asignado solo; sale ya elegido y basta con guardar para confirmarlo
+    directorio, err = cached_parse('plantilla', plantilla_bytes, parse_directorio_persistente)
+    if err:
+        return
+    empleados = directorio['empleados']
+    posiciones = {id(pe): pos for pos, pe in enumerate(empleados)}
+    # Cada nombre ofrece solo sus mejores candidatos, más lo que se busque aquí:
+    # la plantilla entera nunca se lista en un desplegable
+    busqueda = st.text_input("Buscar en la plantilla", key="alias_busqueda", placeholder="Nombre, NIF o código",
+                             help="Añade a cada desplegable los empleados que coincidan")
+    encontrados = [posiciones[id(pe)] for pe in buscar_empleados(directorio, busqueda)] if busqueda.strip() else []
+    with st.form("alias_form"):
+        st.caption("La asignación se recuerda para próximas plantillas.")
+        elegidos = {}
+        for i, nombre in enumerate(sorted(unmatched)):
+            candidatos = [posiciones[id(pe)] for _, pe in match_candidates(
+                directorio, normalize_name(nombre), limit=ALIAS_CANDIDATOS, min_score=ALIAS_MIN_SCORE)]
+            opciones = [None] + list(dict.fromkeys(candidatos + encontrados))
+            propuesto = next((pos for pos in opciones[1:]
+                              if empleados[pos]['nombre'] == (propuestas or {}).get(nombre)), None)
+            elegidos[nombre] = st.selectbox(
+                nombre, opciones, key=f"alias_{i}", index=opciones.index(propuesto),
+                format_func=lambda pos: "— Sin asignar —" if pos is None else empleados[pos]['nombre'])
+        guardar = st.form_submit_button("Guardar asignaciones", width='stretch')
+    if guardar:
+        asignaciones = [(nombre, empleados[pos]) for nombre, pos in elegidos.items() if pos is not None]
+        if asignaciones:
+            save_alias(asignaciones)
+            # Ni el directorio cacheado ni las salidas ya generadas llevan los nuevos alias
+            cache_compartida().invalidar(content_hash(plantilla_bytes))
+            st.session_state.resultado = None
+            st.success(f"{len(asignaciones)} asignaciones guardadas. Vuelve a generar la plantilla.")
+
+
 def main():
     st.set_page_config(page_title="Adaptador Endalia", page_icon="📋", layout="centered")
     init_state()
@@ -421,13 +239,26 @@ def main():
     </div>
     """, unsafe_allow_html=True)
 
+    with st.sidebar:
+        st.markdown("### 🩺 Diagnóstico")
+        diagnostico = st.toggle("Medir etapas", key="diag_on",
+                                help="Tiempo, memoria pico y recuentos de cada etapa de la generación. La memoria "
+                                     "pico solo se mide si no hay otra generación en curso en el servidor")
+        perfilar = st.toggle("Perfilar la próxima generación", key="diag_perfil",
+                             help="Ejecuta la generación bajo cProfile y ofrece el perfil para descargar")
+        if diagnostico:
+            stats = cache_compartida().estadisticas()
+            st.caption(f"Caché compartida: {stats['entradas']} entradas, {stats['bytes'] / 2 ** 20:.0f} MB · "
+                       f"{stats['aciertos']} aciertos, {stats['fallos']} fallos, "
+                       f"{stats['expulsiones']} expulsiones")
+
     st.markdown("---")
 
     # ── 1. Subida de archivos ──
     c1, c2 = st.columns(2)
     with c1:
-        tramos_file = st.file_uploader("📂 Registro de tramos", type=['xlsx'], key='tramos',
-                                        help="Excel exportado con los fichajes")
+        tramos_file = st.file_uploader("📂 Registro de tramos", type=TRAMOS_FORMATOS, key='tramos',
+                                        help="Excel, CSV o Parquet exportado con los fichajes")
     with c2:
         plantilla_file = st.file_uploader("📂 Plantilla Endalia", type=['xlsx'], key='plantilla',
                                            help="Plantilla .xlsx de Endalia con los empleados")
@@ -438,14 +269,13 @@ def main():
         return
 
     # ── Leer tramos ──
-    tramos_bytes = tramos_file.read()
-    wb_tramos = openpyxl.load_workbook(BytesIO(tramos_bytes), data_only=True)
-    tramos_all, error = read_tramos(wb_tramos)
+    tramos_bytes = tramos_file.getvalue()
+    parsed, error = cached_parse('tramos', tramos_bytes, parse_tramos_editor)
     if error:
         st.error(error)
         return
 
-    tramos_sin_fin = [t for t in tramos_all if is_missing_hora_fin(t.get('hora_fin'))]
+    tramos_sin_fin = parsed['pendientes']
     if not tramos_sin_fin:
         st.success("✅ Todos los tramos ya tienen hora de fin. No hay nada pendiente.")
         return
@@ -459,121 +289,275 @@ def main():
     st.markdown("---")
     st.markdown(f"### 🕐 {len(tramos_sin_fin)} tramos pendientes")
 
-    # Aplicar hora en bloque
-    st.markdown("##### Aplicar misma hora a varios tramos")
-    empleados_unicos = sorted(set(t['empleado'] for t in tramos_sin_fin))
+    tabla = parsed['tabla']
+
+    # Los filtros de otro archivo no valen para este
+    clave_tramos = content_hash(tramos_bytes)
+    if st.session_state.get('filtros_de') != clave_tramos:
+        for key in ('filtro_emp', 'filtro_fecha', 'editor_pagina'):
+            st.session_state.pop(key, None)
+        st.session_state.filtros_de = clave_tramos
+
+    # Filtros: delimitan tanto la edición en bloque como la tabla paginada
+    st.markdown("##### Filtrar tramos")
+    f1, f2 = st.columns([3, 2])
+    with f1:
+        filtro_emp = st.multiselect("Empleados", options=sorted(tabla['Empleado'].unique()), key="filtro_emp")
+    with f2:
+        dias = tabla['dia'].dropna()
+        rango = (dias.min().date(), dias.max().date()) if len(dias) else ()
+        filtro_fecha = st.date_input("Fechas", value=rango, format="DD/MM/YYYY", key="filtro_fecha")
+
+    mask = pd.Series(True, index=tabla.index)
+    if filtro_emp:
+        mask &= tabla['Empleado'].isin(filtro_emp)
+    # El rango completo es el valor inicial y no filtra: los tramos sin fecha
+    # válida (NaT) solo se dejan fuera cuando se acota el rango
+    if len(filtro_fecha) == 2 and tuple(filtro_fecha) != rango:
+        mask &= tabla['dia'].between(pd.Timestamp(filtro_fecha[0]), pd.Timestamp(filtro_fecha[1]))
+    filtrados = tabla.index[mask].tolist()
 
+    # Aplicar hora en bloque
+    st.markdown("##### Aplicar misma hora a los tramos filtrados")
     m1, m2 = st.columns([3, 3])
     with m1:
         hora_masiva = st.time_input("Hora fin a aplicar", value=time(17, 0), key="masa_hora")
     with m2:
-        seleccion = st.multiselect("Empleados", options=["— Todos —"] + empleados_unicos, key="masa_sel")
-
-    if st.button("Aplicar hora", use_container_width=True):
-        if seleccion:
-            if "— Todos —" in seleccion:
-                indices = list(range(len(tramos_sin_fin)))
-            else:
-                indices = [i for i, t in enumerate(tramos_sin_fin) if t['empleado'] in seleccion]
-            for i in indices:
-                st.session_state.horas_fin[i] = hora_masiva
-                st.session_state[f"hf_{i}"] = hora_masiva
-            st.rerun()
+        st.markdown("<div style='height:1.75rem'></div>", unsafe_allow_html=True)
+        aplicar = st.button(f"Aplicar hora a {len(filtrados)} tramos", width='stretch',
+                            disabled=len(filtrados) == 0)
+    if aplicar:
+        apply_mass_hora(filtrados, hora_masiva)
+        st.session_state.editor_version += 1
+        st.rerun()
 
     st.markdown("")
     st.markdown("##### Detalle por tramo")
-    st.caption("Puedes ajustar la hora de cada tramo de forma individual.")
-    st.markdown("")
-
-    # Cabecera de tabla
-    hdr1, hdr2, hdr3, hdr4 = st.columns([3, 2, 1.5, 2])
-    with hdr1:
-        st.markdown("**Empleado**")
-    with hdr2:
-        st.markdown("**Fecha**")
-    with hdr3:
-        st.markdown("**Inicio**")
-    with hdr4:
-        st.markdown("**Hora fin**")
-
-    # Filas
-    for i, t in enumerate(tramos_sin_fin):
-        c1, c2, c3, c4 = st.columns([3, 2, 1.5, 2])
-        with c1:
-            st.text(t['empleado'])
-        with c2:
-            st.text(fmt_date(t.get('fecha')))
-        with c3:
-            st.text(fmt_time(t.get('hora_inicio')))
-        with c4:
-            new_val = st.time_input(
-                "fin", value=st.session_state.horas_fin[i],
-                key=f"hf_{i}", label_visibility="collapsed"
-            )
-            st.session_state.horas_fin[i] = new_val
+    st.caption("Edita las horas de la página y pulsa «Guardar cambios» para aplicarlas de una vez.")
+
+    n_paginas = max(1, -(-len(filtrados) // EDITOR_PAGE_SIZE))
+    if st.session_state.get('editor_pagina', 1) > n_paginas:
+        st.session_state.editor_pagina = 1
+    pagina = st.number_input(f"Página (de {n_paginas})", min_value=1, max_value=n_paginas, value=1,
+                             step=1, key="editor_pagina")
+    pagina_idx = filtrados[(pagina - 1) * EDITOR_PAGE_SIZE:pagina * EDITOR_PAGE_SIZE]
+    vista = tabla.loc[pagina_idx, ['Empleado', 'Fecha', 'Inicio']].copy()
+    # object incluso sin filas: una columna vacía sería float y el editor no la admite como hora
+    vista['Hora fin'] = pd.Series([st.session_state.horas_fin[i] for i in pagina_idx], index=vista.index,
+                                  dtype=object)
+
+    with st.form("editor_horas"):
+        editado = st.data_editor(
+            vista, key=f"editor_{st.session_state.editor_version}_{pagina}",
+            hide_index=True, width='stretch',
+            disabled=['Empleado', 'Fecha', 'Inicio'],
+            column_config={
+                'Hora fin': st.column_config.TimeColumn("Hora fin", format="HH:mm", step=60, required=True),
+            },
+        )
+        guardar = st.form_submit_button("Guardar cambios", width='stretch')
+    if guardar:
+        st.session_state.horas_fin.update(
+            (i, hora) for i, hora in zip(editado.index, editado['Hora fin']) if hora is not None)
+        st.session_state.editor_version += 1
+        st.rerun()
 
     # ── 3. Generar ──
     st.markdown("---")
 
-    if st.button("🚀 Generar plantilla", type="primary", use_container_width=True):
-        # Aplicar horas finales
-        for i, t in enumerate(tramos_sin_fin):
-            t['hora_fin'] = st.session_state.horas_fin[i]
-
-        with st.spinner("Generando plantilla..."):
-            try:
-                plantilla_bytes = plantilla_file.read()
-                wb_template = openpyxl.load_workbook(BytesIO(plantilla_bytes), data_only=False)
-                output_rows, unmatched, removed, err = conciliar(wb_template, tramos_sin_fin)
-
+    with st.expander("✂️ Dividir la salida en varias plantillas"):
+        modo = st.selectbox("Dividir", [None] + list(PARTICIONES), key='particion_modo',
+                            format_func=lambda m: PARTICIONES.get(m, "No dividir"))
+        particion = None
+        if modo == 'filas':
+            particion = (modo, st.number_input("Filas por plantilla", min_value=1, value=50000, step=1000))
+        elif modo == 'empleados':
+            particion = (modo, st.number_input("Empleados por plantilla", min_value=1, value=500, step=50))
+        elif modo is not None:
+            particion = (modo, None)
+        if particion is not None:
+            st.caption("Se descargará un .zip con una plantilla completa por parte.")
+
+    with st.expander("🔁 Exportar solo los tramos nuevos o cambiados"):
+        modo_delta = st.selectbox("Comparar", [None] + list(DELTA_ORIGENES), key='delta_modo',
+                                  format_func=lambda m: DELTA_ORIGENES.get(m, "No: exportar todos"))
+        delta = None
+        if modo_delta == 'almacen':
+            delta = ('almacen', DIRECTORIO_DB)
+            st.caption("Cada descarga queda registrada: se omiten los tramos ya descargados que no han cambiado.")
+        elif modo_delta == 'salida':
+            anterior_file = st.file_uploader("Salida anterior", type=['xlsx', 'zip'], key='salida_anterior',
+                                             help="Plantilla o .zip de plantillas generado en una ejecución previa")
+            if anterior_file is not None:
+                huellas, err = cached_parse('huellas', anterior_file.getvalue(), huellas_de_salida)
                 if err:
                     st.error(err)
-                    return
+                else:
+                    delta = ('salida', huellas)
 
-                buf = BytesIO()
-                wb_template.save(buf)
-                output_bytes = patch_zip_with_validations(buf.getvalue(), plantilla_bytes)
+    if st.session_state.trabajo is not None:
+        panel_generacion()
+        return
 
-                st.session_state.resultado = {
-                    'bytes': output_bytes,
-                    'rows': output_rows,
-                    'unmatched': unmatched,
-                }
-            except Exception as e:
-                st.error(f"Ha ocurrido un error: {str(e)}")
-                return
+    if st.button("🚀 Generar plantilla", type="primary", width='stretch'):
+        plantilla_bytes = plantilla_file.getvalue()
+        directorio, err = cached_parse('plantilla', plantilla_bytes, parse_directorio_persistente)
+        if err:
+            st.error(err)
+            return
+        prep, _ = cached_parse('prep', plantilla_bytes, partial(prepare_template, cols=directorio['cols']))
+        # Con las mismas entradas que la última generación, solo se rehacen
+        # las filas cuya hora fin ha cambiado desde entonces
+        horas = dict(st.session_state.horas_fin)
+        clave = (content_hash(tramos_bytes), content_hash(plantilla_bytes), particion)
+        # Otra sesión puede haber generado ya exactamente esta salida (salvo en
+        # modo delta: depende de lo exportado hasta ahora)
+        cache = cache_compartida()
+        clave_salida = None if delta is not None else ('salida',) + clave + (horas_hash(horas),)
+        hecho = None if perfilar or clave_salida is None else cache.obtener(clave_salida)
+        if hecho is not None:
+            st.session_state.error_generacion = None
+            st.session_state.resultado = dict(hecho, metricas=[], perfil=None, perfil_resumen=None)
+            st.rerun()
+        anterior = st.session_state.resultado
+        # Aplicar horas finales (sin tocar los tramos cacheados)
+        if delta is None and anterior is not None and anterior.get('clave') == clave and anterior['estado']:
+            cambios = {i: tramos_sin_fin[i].con_hora_fin(h) for i, h in horas.items()
+                       if anterior['horas'].get(i) != h}
+            tarea = partial(regenerar_plantilla, anterior, cambios)
+        else:
+            tramos_completos = [t.con_hora_fin(horas[i]) for i, t in enumerate(tramos_sin_fin)]
+            tarea = partial(generar_plantilla, tramos_completos, plantilla_bytes, directorio,
+                            particion=particion, prep=prep, incremental=True, delta=delta,
+                            cerrados=parsed['cerrados'])
+
+        def generar(progreso, metricas):
+            resultado, err = tarea(metricas=metricas, progreso=progreso)
+            if resultado is not None:
+                with medir_etapa('resumen', metricas, filas=len(resultado['rows'])):
+                    resumen = resumir_resultado(resultado)
+                # La salida se comparte: cada descarga la lee con su cerrojo
+                resultado = dict(resultado, clave=clave, horas=horas, lectura=threading.Lock(), resumen=resumen)
+                if clave_salida is not None:
+                    cache.guardar(clave_salida, resultado, tamano_resultado(resultado), ttl=SALIDA_TTL_SECONDS)
+            return resultado, err
+
+        st.session_state.error_generacion = None
+        st.session_state.trabajo = lanzar_generacion(generar, perfilar, diagnostico)
+        st.rerun()
+
+    if st.session_state.error_generacion:
+        st.error(st.session_state.error_generacion)
 
     # ── 4. Resultado ──
     if st.session_state.resultado:
         res = st.session_state.resultado
         st.markdown("---")
         st.markdown(f"### ✅ {len(res['rows'])} registros listos para importar")
+        if res['sin_cambios']:
+            st.info(f"Se han omitido {res['sin_cambios']} tramos ya exportados que no han cambiado.")
+
+        asignadas = [a for a in res['aproximadas'] if a['asignado']]
+        if asignadas:
+            st.warning(f"{len(asignadas)} nombres no están tal cual en la plantilla y se han asignado al empleado "
+                       "más parecido. Revisa que sean la misma persona.")
+            with st.expander("Ver coincidencias aproximadas"):
+                st.dataframe(asignadas, width='stretch', hide_index=True)
 
         if res['unmatched']:
+            propuestas = {a['empleado']: a['candidato'] for a in res['aproximadas'] if not a['asignado']}
             st.warning(f"Empleados no encontrados en la plantilla: {', '.join(sorted(res['unmatched']))}")
-
-        preview = []
-        for r in res['rows']:
-            preview.append({
-                'Empleado': r['nombre'],
-                'Fecha': fmt_date(r['fecha_ref']),
-                'Inicio': fmt_time(r['inicio']) if r['inicio'] else '',
-                'Fin': fmt_time(r['fin']) if r['fin'] else '',
-                'Tipo de tramo': r['tipo_tramo'],
-            })
-
-        st.dataframe(preview, use_container_width=True, hide_index=True)
+            if propuestas:
+                st.caption(f"{len(propuestas)} se parecen a un empleado de la plantilla: la propuesta sale ya "
+                           "elegida en el formulario y se asigna al guardarlo.")
+            with st.expander("Asignar empleados no encontrados", expanded=bool(propuestas)):
+                render_alias_form(res['unmatched'], plantilla_file.getvalue(), propuestas)
+
+        if res['rechazos']:
+            st.warning(f"{len(res['rechazos'])} valores de fecha u hora con formato mixto o no válido.")
+            with st.expander("Ver valores rechazados"):
+                st.dataframe(res['rechazos'], width='stretch', hide_index=True)
+
+        if res['incidencias']:
+            st.error(f"{len(res['incidencias'])} tramos se solapan, están duplicados o no tienen duración. "
+                     "Endalia rechazará la importación: corrige sus horas y vuelve a generar.")
+            with st.expander("Ver tramos con incidencias", expanded=True):
+                st.dataframe(res['incidencias'], width='stretch', hide_index=True)
+
+        resumen = res['resumen']
+        tabla = resumen['tabla']
+        m1, m2, m3, m4 = st.columns(4)
+        m1.metric("Empleados", len(resumen['por_empleado']))
+        m2.metric("Horas", f"{resumen['horas']:,.0f}".replace(',', '.'))
+        m3.metric("No encontrados", resumen['no_encontrados'],
+                  help="Empleados de los tramos que no están en la plantilla")
+        m4.metric("Sin tramos", resumen['sin_tramos'],
+                  help="Empleados de la plantilla sin ningún tramo en esta generación")
+
+        columnas = {
+            'Fecha': st.column_config.DateColumn("Fecha", format="DD/MM/YYYY"),
+            'Inicio': st.column_config.DatetimeColumn("Inicio", format="HH:mm"),
+            'Fin': st.column_config.DatetimeColumn("Fin", format="HH:mm"),
+            'Horas': st.column_config.NumberColumn("Horas", format="%.2f"),
+        }
+        registros, empleados, dias = st.tabs(["Registros", "Horas por empleado", "Tramos por día"])
+        with registros:
+            n_paginas = max(1, -(-len(tabla) // RESULTADO_PAGE_SIZE))
+            if st.session_state.get('resultado_pagina', 1) > n_paginas:
+                st.session_state.resultado_pagina = 1
+            pagina = st.number_input(f"Página (de {n_paginas})", min_value=1, max_value=n_paginas, value=1,
+                                     step=1, key="resultado_pagina")
+            st.dataframe(tabla.iloc[(pagina - 1) * RESULTADO_PAGE_SIZE:pagina * RESULTADO_PAGE_SIZE],
+                         width='stretch', hide_index=True, column_config=columnas)
+        with empleados:
+            st.dataframe(resumen['por_empleado'], width='stretch', hide_index=True,
+                         column_config=columnas)
+        with dias:
+            st.dataframe(resumen['por_dia'], width='stretch', hide_index=True, column_config=columnas)
+
+        if diagnostico or res.get('perfil'):
+            with st.expander("🩺 Diagnóstico de la generación", expanded=True):
+                if res['metricas']:
+                    st.dataframe(res['metricas'], width='stretch', hide_index=True)
+                else:
+                    st.caption("Salida servida desde la caché compartida: no se ha vuelto a generar.")
+                if res.get('perfil'):
+                    st.download_button(
+                        label="Descargar perfil (.prof)",
+                        data=res['perfil'],
+                        file_name=f"perfil_{datetime.now().strftime('%Y%m%d_%H%M%S')}.prof",
+                        mime="application/octet-stream",
+                    )
+                    st.code(res['perfil_resumen'], language=None)
 
         st.markdown("")
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        st.download_button(
-            label="📥 Descargar plantilla",
-            data=res['bytes'],
-            file_name=f"endalia_{timestamp}.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet",
-            type="primary",
-            use_container_width=True,
-        )
+        # Cada descarga se registra para poder exportar después solo lo que cambie
+        directorio, _ = cached_parse('plantilla', plantilla_file.getvalue(), parse_directorio_persistente)
+        registrar = partial(save_huellas, res['rows'], directorio['cols']) if directorio is not None else 'ignore'
+        if res['partes']:
+            st.caption(f"{len(res['partes'])} plantillas: "
+                       + ", ".join(f"{etiqueta} ({n} filas)" for etiqueta, n in res['partes']))
+            st.download_button(
+                label=f"📥 Descargar {len(res['partes'])} plantillas (.zip)",
+                data=partial(leer_salida, res['salida'], res['lectura']),
+                file_name=f"endalia_{timestamp}.zip",
+                mime="application/zip",
+                type="primary",
+                width='stretch',
+                on_click=registrar,
+            )
+        else:
+            st.download_button(
+                label="📥 Descargar plantilla",
+                data=partial(leer_salida, res['salida'], res['lectura']),
+                file_name=f"endalia_{timestamp}.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet",
+                type="primary",
+                width='stretch',
+                on_click=registrar,
+            )
 
 
-main()
+if __name__ == "__main__":
+    main()
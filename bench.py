@@ -0,0 +1,283 @@
+"""Banco de pruebas de rendimiento con datos sintéticos.
+
+Genera exportaciones de tramos y plantillas Endalia del tamaño pedido y mide
+tiempo y memoria pico de cada etapa por separado. Ejemplos:
+
+    python bench.py                                   # casos por defecto
+    python bench.py --caso 100000x5000 --caso 1000000x50000 --motor openpyxl
+    python bench.py --salida resultados.json --datos /tmp/bench-datos
+    python bench.py --caso 500000x5000 --entrada csv
+"""
+import argparse
+import csv
+import json
+import platform
+import random
+import subprocess
+import sys
+import tracemalloc
+from datetime import date, datetime, time, timedelta
+from io import BytesIO, StringIO
+from pathlib import Path
+from time import perf_counter
+
+import openpyxl
+import pandas as pd
+from openpyxl.worksheet.datavalidation import DataValidation
+
+import endalia
+
+CASOS_DEFECTO = ['1000x100', '10000x1000', '100000x5000']
+NOMBRES = ['José', 'María', 'Ángel', 'Lucía', 'Íñigo', 'Begoña', 'Raúl', 'Sofía', 'Jesús', 'Nuria',
+           'Óscar', 'Inés', 'Andrés', 'Carmen', 'Joaquín', 'Elena', 'Rubén', 'Marta', 'Adrián', 'Noemí']
+APELLIDOS = ['García', 'Fernández', 'González', 'Rodríguez', 'López', 'Martínez', 'Sánchez', 'Pérez',
+             'Gómez', 'Martín', 'Jiménez', 'Ruiz', 'Hernández', 'Díaz', 'Moreno', 'Muñoz', 'Álvarez',
+             'Romero', 'Alonso', 'Gutiérrez', 'Navarro', 'Torres', 'Domínguez', 'Vázquez', 'Ramos']
+TIPOS_TRAMO = ['Trabajo', 'Pausa', 'Comida']
+
+
+# ═══════════════════════════════════════════════════
+# Generadores
+# ═══════════════════════════════════════════════════
+
+def nombres_empleados(n, seed=0):
+    rnd = random.Random(seed)
+    nombres = set()
+    while len(nombres) < n:
+        nombre = f"{rnd.choice(NOMBRES)} {rnd.choice(APELLIDOS)} {rnd.choice(APELLIDOS)}"
+        if nombre in nombres:
+            nombre = f"{nombre} {len(nombres)}"
+        nombres.add(nombre)
+    return sorted(nombres)
+
+
+def variante_nombre(nombre, rnd):
+    # Las exportaciones de fichajes no siempre escriben el nombre igual que Endalia
+    r = rnd.random()
+    if r < 0.15:
+        return endalia.remove_accents(nombre)
+    if r < 0.25:
+        return nombre.upper()
+    if r < 0.32:
+        return '  ' + nombre.replace(' ', '  ') + ' '
+    return nombre
+
+
+def generar_plantilla(n_empleados, seed=0):
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet(endalia.TEMPLATE_SHEET)
+    ws.append(['Doc. identificador', 'Código empleado', 'Empleado', 'Fecha de referencia', 'Zona horaria',
+               'Inicio', 'Fin', 'Tipo de tramo', 'Sobrescritura'])
+    nombres = nombres_empleados(n_empleados, seed)
+    for i, nombre in enumerate(nombres):
+        ws.append([f"{10000000 + i}{'TRWAGMYFPDXBNJZSQVHLCKE'[i % 23]}", f"E{i:06d}", nombre])
+    dv = DataValidation(type='list', formula1='"Sí,No"', allow_blank=True)
+    dv.add(f"I2:I{n_empleados + 1}")
+    ws.data_validations.append(dv)
+    buf = BytesIO()
+    wb.save(buf)
+    return buf.getvalue(), nombres
+
+
+def generar_tramos(n_filas, nombres, pct_sin_fin=0.3, seed=0):
+    rnd = random.Random(seed)
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet('Tramos')
+    ws.append(['Empleado', 'Fecha', 'Hora inicio', 'Hora fin', 'Tipo de tramo'])
+    inicio_mes = date(2026, 9, 1)
+    for _ in range(n_filas):
+        dia = inicio_mes + timedelta(days=rnd.randrange(30))
+        r = rnd.random()
+        if r < 0.6:
+            fecha = datetime.combine(dia, time(0, 0))
+        elif r < 0.9:
+            fecha = dia.strftime('%d/%m/%Y')
+        else:
+            fecha = dia.strftime('%Y-%m-%d')
+        hora_inicio = time(rnd.randint(6, 10), rnd.choice([0, 15, 30, 45]))
+        if rnd.random() < pct_sin_fin:
+            hora_fin = None if rnd.random() < 0.5 else '00:00'
+        else:
+            hora_fin = time(rnd.randint(13, 19), rnd.choice([0, 30]))
+        ws.append([variante_nombre(rnd.choice(nombres), rnd), fecha,
+                   hora_inicio if rnd.random() < 0.7 else hora_inicio.strftime('%H:%M'),
+                   hora_fin, rnd.choice(TIPOS_TRAMO)])
+    buf = BytesIO()
+    wb.save(buf)
+    return buf.getvalue()
+
+
+def exportar_tramos(tramos_bytes, formato):
+    # Misma exportación en CSV o Parquet, todo como texto, como la daría el reloj de fichajes
+    wb = openpyxl.load_workbook(BytesIO(tramos_bytes), read_only=True)
+    filas = wb.active.iter_rows(values_only=True)
+    cabecera = next(filas)
+
+    def texto(v):
+        if isinstance(v, datetime):
+            return endalia.fmt_date(v)
+        if isinstance(v, time):
+            return endalia.fmt_time(v)
+        return v if v is None else str(v)
+
+    valores = [[texto(v) for v in fila] for fila in filas]
+    wb.close()
+    if formato == 'parquet':
+        buf = BytesIO()
+        pd.DataFrame(valores, columns=cabecera).to_parquet(buf)
+        return buf.getvalue()
+    buf = StringIO()
+    writer = csv.writer(buf, delimiter=';', lineterminator='\r\n')
+    writer.writerow(cabecera)
+    writer.writerows(valores)
+    return buf.getvalue().encode('utf-8-sig')
+
+
+def cargar_o_generar(datos, n_filas, n_empleados):
+    # Generar un millón de filas lleva su tiempo: se reutilizan los ficheros ya creados
+    if datos is not None:
+        datos.mkdir(parents=True, exist_ok=True)
+        tramos_path = datos / f"tramos_{n_filas}x{n_empleados}.xlsx"
+        plantilla_path = datos / f"plantilla_{n_empleados}.xlsx"
+        if tramos_path.exists() and plantilla_path.exists():
+            return tramos_path.read_bytes(), plantilla_path.read_bytes()
+    plantilla_bytes, nombres = generar_plantilla(n_empleados)
+    tramos_bytes = generar_tramos(n_filas, nombres)
+    if datos is not None:
+        plantilla_path.write_bytes(plantilla_bytes)
+        tramos_path.write_bytes(tramos_bytes)
+    return tramos_bytes, plantilla_bytes
+
+
+# ═══════════════════════════════════════════════════
+# Etapas
+# ═══════════════════════════════════════════════════
+
+def etapas(tramos_bytes, plantilla_bytes, motor, entrada='xlsx'):
+    # Cada etapa recibe el estado de la anterior y deja el suyo en `ctx`
+    ctx = {}
+
+    def load():
+        if entrada == 'xlsx':
+            ctx['wb_tramos'] = endalia.open_tramos_workbook(tramos_bytes)
+        else:
+            ctx['df_tramos'] = endalia.read_tramos_frame(tramos_bytes, entrada)
+        ctx['directorio'], _ = endalia.parse_directorio(plantilla_bytes)
+        if motor == 'openpyxl':
+            ctx['wb_template'] = openpyxl.load_workbook(BytesIO(plantilla_bytes), data_only=False)
+        else:
+            ctx['prep'], _ = endalia.prepare_template(plantilla_bytes, ctx['directorio']['cols'])
+
+    def read_tramos():
+        if entrada == 'xlsx':
+            tramos, _ = endalia.iter_tramos(ctx['wb_tramos'].active)
+            pendientes = [t for t in tramos if endalia.is_missing_hora_fin(t.hora_fin)]
+            ctx['wb_tramos'].close()
+        else:
+            pendientes = endalia.tramos_pendientes_frame(ctx.pop('df_tramos'))[0]['pendientes']
+        ctx['tramos'] = [t.con_hora_fin(endalia.HORA_FIN_DEFAULT) for t in pendientes]
+        return len(ctx['tramos'])
+
+    def conciliar():
+        fechas = endalia.parse_tramos_fechas(ctx['tramos'])
+        if motor == 'openpyxl':
+            rows, _, _, _ = endalia.conciliar(ctx['wb_template'], ctx['tramos'], ctx['directorio'], fechas)
+        else:
+            rows, _, _, _ = endalia.conciliar_tramos(ctx['tramos'], ctx['directorio'], fechas)
+        ctx['rows'] = rows
+        return len(rows)
+
+    def save():
+        if motor == 'openpyxl':
+            buf = BytesIO()
+            ctx['wb_template'].save(buf)
+            ctx['output'] = buf.getvalue()
+        else:
+            ctx['output'] = endalia.write_streaming_plantilla(ctx['prep'], ctx['rows'])
+        return len(ctx['output'])
+
+    def patch_zip_with_validations():
+        if motor == 'openpyxl':
+            ctx['output'] = endalia.patch_zip_with_validations(ctx['output'], plantilla_bytes)
+        return len(ctx['output'])
+
+    return [load, read_tramos, conciliar, save, patch_zip_with_validations]
+
+
+def medir(tramos_bytes, plantilla_bytes, motor, memoria, entrada='xlsx'):
+    resultados = {}
+    for etapa in etapas(tramos_bytes, plantilla_bytes, motor, entrada):
+        inicio = perf_counter()
+        cantidad = etapa()
+        resultados[etapa.__name__] = {'segundos': perf_counter() - inicio, 'cantidad': cantidad}
+    if memoria:
+        # Segunda pasada con tracemalloc: su sobrecoste no contamina los tiempos
+        tracemalloc.start()
+        try:
+            for etapa in etapas(tramos_bytes, plantilla_bytes, motor, entrada):
+                tracemalloc.reset_peak()
+                base = tracemalloc.get_traced_memory()[0]
+                etapa()
+                resultados[etapa.__name__]['pico_mb'] = (tracemalloc.get_traced_memory()[1] - base) / 2 ** 20
+        finally:
+            tracemalloc.stop()
+    return resultados
+
+
+def version_repo():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              cwd=Path(__file__).parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_caso(valor):
+    try:
+        filas, empleados = (int(x) for x in valor.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"caso no válido: {valor!r} (formato FILASxEMPLEADOS)")
+    return filas, empleados
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mide cada etapa de la conversión con datos sintéticos.")
+    parser.add_argument('--caso', type=parse_caso, action='append', metavar='FILASxEMPLEADOS',
+                        help=f"Tamaño a medir (se puede repetir; por defecto {', '.join(CASOS_DEFECTO)})")
+    parser.add_argument('--motor', choices=['directo', 'openpyxl'], default='directo',
+                        help="Escritura directa en el zip o vía openpyxl + patch_zip_with_validations")
+    parser.add_argument('--entrada', choices=endalia.TRAMOS_FORMATOS, default='xlsx',
+                        help="Formato de la exportación de tramos que se lee")
+    parser.add_argument('--datos', type=Path, help="Carpeta donde guardar/reutilizar los ficheros generados")
+    parser.add_argument('--sin-memoria', action='store_true', help="Omite la pasada con tracemalloc")
+    parser.add_argument('--salida', type=Path, help="Fichero JSON de resultados (por defecto, stdout)")
+    args = parser.parse_args(argv)
+
+    informe = {
+        'version': version_repo(),
+        'fecha': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'motor': args.motor,
+        'entrada': args.entrada,
+        'casos': [],
+    }
+    for filas, empleados in args.caso or [parse_caso(c) for c in CASOS_DEFECTO]:
+        print(f"· {filas} filas × {empleados} empleados", file=sys.stderr)
+        tramos_bytes, plantilla_bytes = cargar_o_generar(args.datos, filas, empleados)
+        if args.entrada != 'xlsx':
+            tramos_bytes = exportar_tramos(tramos_bytes, args.entrada)
+        etapas_medidas = medir(tramos_bytes, plantilla_bytes, args.motor, not args.sin_memoria, args.entrada)
+        for nombre, m in etapas_medidas.items():
+            pico = f", {m['pico_mb']:.1f} MB" if 'pico_mb' in m else ''
+            print(f"    {nombre:<28} {m['segundos']:8.3f}s{pico}", file=sys.stderr)
+        informe['casos'].append({'filas': filas, 'empleados': empleados, 'etapas': etapas_medidas})
+
+    texto = json.dumps(informe, indent=2, ensure_ascii=False)
+    if args.salida:
+        args.salida.write_text(texto + '\n', encoding='utf-8')
+    else:
+        print(texto)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""Conversión por lotes sin interfaz.
+
+Ejemplos:
+
+    python cli.py --plantilla plantilla.xlsx centro1.xlsx centro2.xlsx -o salida/
+    python cli.py --par centro1.xlsx plantilla1.xlsx --par centro2.xlsx plantilla2.xlsx --jornada 8
+    python cli.py --plantilla plantilla.xlsx grande.xlsx --partir filas --limite 50000
+    python cli.py --plantilla plantilla.xlsx fichajes.csv lago/septiembre.parquet
+    python cli.py --plantilla plantilla.xlsx hoy.xlsx --delta                  # solo lo nuevo o cambiado
+    python cli.py --plantilla plantilla.xlsx hoy.xlsx --desde endalia_ayer.xlsx
+"""
+import argparse
+import logging
+import os
+import shutil
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from pathlib import Path
+from time import perf_counter
+
+import endalia
+
+
+def parse_hora(valor):
+    try:
+        return datetime.strptime(valor, '%H:%M').time()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"hora no válida: {valor!r} (formato HH:MM)")
+
+
+def convertir_archivo(tramos_path, plantilla_path, salida_path, politica, particion=None, db_path=None,
+                      delta=None, desde=None):
+    # `delta`: comparar con el almacén de `db_path`; `desde`: con esa salida anterior
+    inicio = perf_counter()
+    informe = {'tramos': str(tramos_path), 'plantilla': str(plantilla_path), 'salida': None, 'error': None}
+    if desde is not None:
+        huellas, err = endalia.huellas_de_salida(Path(desde).read_bytes())
+        if err:
+            informe.update(error=err, segundos=perf_counter() - inicio)
+            return informe
+        delta = ('salida', huellas)
+    else:
+        delta = ('almacen', db_path) if delta else None
+    resultado, err = endalia.convertir(Path(tramos_path).read_bytes(), Path(plantilla_path).read_bytes(), politica,
+                                       particion=particion, db_path=db_path, delta=delta)
+    informe['error'] = err
+    if resultado is not None:
+        with resultado['salida'] as salida, open(salida_path, 'wb') as fh:
+            salida.seek(0)
+            shutil.copyfileobj(salida, fh)
+        if delta is not None and delta[0] == 'almacen':
+            # Sin interfaz no hay descarga: lo que ya está escrito se da por exportado
+            endalia.save_huellas(resultado['rows'], resultado['cols'], db_path)
+        informe.update({
+            'salida': str(salida_path),
+            'total': resultado['total'],
+            'pendientes': resultado['pendientes'],
+            'filas': len(resultado['rows']),
+            'no_encontrados': len(resultado['unmatched']),
+            'aproximadas': resultado['aproximadas'],
+            'rechazos': len(resultado['rechazos']),
+            'incidencias': len(resultado['incidencias']),
+            'sin_cambios': resultado['sin_cambios'],
+            'partes': len(resultado['partes']) if resultado['partes'] else None,
+        })
+    informe['segundos'] = perf_counter() - inicio
+    return informe
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Genera plantillas de importación de Endalia por lotes.")
+    parser.add_argument('tramos', nargs='*', help="Exportaciones de tramos (.xlsx, .csv o .parquet) que usan la plantilla de --plantilla")
+    parser.add_argument('--plantilla', help="Plantilla Endalia común a los tramos posicionales")
+    parser.add_argument('--par', nargs=2, action='append', default=[], metavar=('TRAMOS', 'PLANTILLA'),
+                        help="Pareja tramos/plantilla (se puede repetir)")
+    parser.add_argument('-o', '--salida', default='.', help="Carpeta de salida (por defecto, la actual)")
+    politica = parser.add_mutually_exclusive_group()
+    politica.add_argument('--hora-fin', type=parse_hora, default=endalia.HORA_FIN_DEFAULT,
+                          help="Hora fin fija para los tramos pendientes (HH:MM, por defecto 17:00)")
+    politica.add_argument('--jornada', type=float, metavar='HORAS',
+                          help="Calcula la hora fin como inicio + HORAS")
+    parser.add_argument('--partir', choices=list(endalia.PARTICIONES),
+                        help="Divide cada salida en varias plantillas dentro de un .zip")
+    parser.add_argument('--limite', type=int, metavar='N',
+                        help="Filas (--partir filas) o empleados (--partir empleados) por plantilla")
+    db = parser.add_mutually_exclusive_group()
+    db.add_argument('--db', default=endalia.DIRECTORIO_DB, metavar='RUTA',
+                    help=f"Almacén SQLite de directorios y asignaciones (por defecto, {endalia.DIRECTORIO_DB})")
+    db.add_argument('--sin-db', action='store_true', help="Lee siempre el directorio de la plantilla")
+    delta = parser.add_mutually_exclusive_group()
+    delta.add_argument('--delta', action='store_true',
+                       help="Solo tramos nuevos o cambiados respecto a lo ya exportado (se guarda en --db)")
+    delta.add_argument('--desde', metavar='SALIDA',
+                       help="Solo tramos nuevos o cambiados respecto a esa salida anterior (.xlsx o .zip)")
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(),
+                        help="Procesos en paralelo (por defecto, uno por núcleo)")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help="Emite por stderr una línea JSON por etapa y archivo")
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.tramos and not args.plantilla:
+        parser.error("los tramos posicionales necesitan --plantilla")
+    pares = [(t, args.plantilla) for t in args.tramos] + [tuple(p) for p in args.par]
+    if not pares:
+        parser.error("no hay nada que convertir")
+    if args.partir in ('filas', 'empleados') and not (args.limite and args.limite > 0):
+        parser.error(f"--partir {args.partir} necesita --limite N (N > 0)")
+    particion = (args.partir, args.limite) if args.partir else None
+    extension = 'zip' if particion else 'xlsx'
+    db_path = None if args.sin_db else args.db
+    if args.delta and db_path is None:
+        parser.error("--delta necesita el almacén: no se puede combinar con --sin-db")
+
+    if args.verbose:
+        endalia.configurar_log(logging.INFO)
+
+    politica = timedelta(hours=args.jornada) if args.jornada is not None else args.hora_fin
+    salida = Path(args.salida)
+    salida.mkdir(parents=True, exist_ok=True)
+
+    inicio = perf_counter()
+    informes = []
+    with ProcessPoolExecutor(max_workers=max(1, min(args.workers, len(pares)))) as pool:
+        futures = {
+            pool.submit(convertir_archivo, tramos, plantilla,
+                        salida / f"endalia_{Path(tramos).stem}_{i:03d}.{extension}", politica, particion,
+                        db_path, args.delta, args.desde): tramos
+            for i, (tramos, plantilla) in enumerate(pares, start=1)
+        }
+        for future in as_completed(futures):
+            try:
+                informe = future.result()
+            except Exception as e:
+                informe = {'tramos': futures[future], 'error': str(e), 'segundos': 0.0}
+            informes.append(informe)
+            if informe['error']:
+                print(f"✗ {informe['tramos']}: {informe['error']}")
+            else:
+                partes = f" en {informe['partes']} plantillas" if informe['partes'] else ''
+                if informe['sin_cambios'] is not None:
+                    partes += f" ({informe['sin_cambios']} sin cambios omitidas)"
+                print(f"✓ {informe['tramos']} → {informe['salida']}: {informe['filas']} filas{partes}, "
+                      f"{informe['no_encontrados']} empleados sin encontrar, "
+                      f"{informe['rechazos']} fechas/horas rechazadas ({informe['segundos']:.2f}s)")
+                if informe['incidencias']:
+                    print(f"  ⚠ {informe['incidencias']} tramos solapados, duplicados o sin duración: "
+                          f"Endalia rechazará la importación")
+                # Nombres que no están tal cual en la plantilla: asignados por parecido o solo propuestos
+                for a in informe['aproximadas']:
+                    if a['asignado']:
+                        print(f"  ≈ {a['empleado']!r} asignado a {a['candidato']!r} por parecido "
+                              f"({a['similitud']:.2f}, {a['tramos']} tramos): compruébalo")
+                    else:
+                        print(f"  ? {a['empleado']!r} podría ser {a['candidato']!r} ({a['similitud']:.2f}): "
+                              f"sin asignar, confírmalo en la aplicación")
+
+    duracion = perf_counter() - inicio
+    ok = [i for i in informes if not i['error']]
+    filas = sum(i['filas'] for i in ok)
+    print(f"\n{len(ok)}/{len(informes)} archivos en {duracion:.2f}s — "
+          f"{len(informes) / duracion:.2f} archivos/s, {filas / duracion:.0f} filas/s")
+    return 0 if len(ok) == len(informes) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
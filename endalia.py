@@ -0,0 +1,2483 @@
+"""Motor de conversión de tramos a plantillas de importación de Endalia.
+
+Todo lo que no es interfaz: lectura de tramos y plantillas, conciliación,
+escritura de la salida, instrumentación y caché. Lo usan la aplicación
+Streamlit (app.py), la conversión por lotes (cli.py) y bench.py.
+"""
+import openpyxl
+import pandas as pd
+from io import BytesIO, StringIO
+from zipfile import BadZipFile, ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
+import xml.etree.ElementTree as ET
+import re
+import sqlite3
+import struct
+import sys
+import threading
+from datetime import datetime, time, date, timedelta
+from copy import copy
+from collections import Counter, OrderedDict
+from bisect import bisect_right
+from functools import lru_cache, partial
+from itertools import compress
+from math import ceil
+from operator import attrgetter
+from time import localtime, monotonic, perf_counter
+from contextlib import closing, contextmanager, nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import codecs
+import csv
+import hashlib
+import json
+import logging
+import marshal
+import multiprocessing
+import os
+import posixpath
+import pstats
+import shutil
+import tempfile
+import tracemalloc
+import unicodedata
+import zlib
+from xml.sax.saxutils import escape, unescape
+from openpyxl.cell.cell import Cell
+from openpyxl.utils import column_index_from_string, get_column_letter
+from openpyxl.utils.datetime import to_excel
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+SPREADSHEET_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+ET.register_namespace('', SPREADSHEET_NS)
+ET.register_namespace('r', 'http://schemas.openxmlformats.org/officeDocument/2006/relationships')
+ET.register_namespace('mc', 'http://schemas.openxmlformats.org/markup-compatibility/2006')
+ET.register_namespace('x14ac', 'http://schemas.microsoft.com/office/spreadsheetml/2009/9/ac')
+ET.register_namespace('xr', 'http://schemas.microsoft.com/office/spreadsheetml/2014/revision')
+ET.register_namespace('xr2', 'http://schemas.microsoft.com/office/spreadsheetml/2015/revision2')
+ET.register_namespace('xr3', 'http://schemas.microsoft.com/office/spreadsheetml/2016/revision3')
+ET.register_namespace('xr6', 'http://schemas.microsoft.com/office/spreadsheetml/2014/revision6')
+ET.register_namespace('xr10', 'http://schemas.microsoft.com/office/spreadsheetml/2018/revision10')
+
+ZONA_DEFAULT = "(UTC+01:00) Bruselas, Copenhague, Madrid, París"
+SOBRESCRITURA_DEFAULT = "Sí"
+TEMPLATE_SHEET = "Registros de jornada"
+HEADER_ROW = 1
+
+# Columna de la plantilla -> campo de cada fila de salida
+OUTPUT_FIELDS = {
+    'nif': 'nif',
+    'codigo': 'codigo',
+    'empleado': 'nombre',
+    'fecha_ref': 'fecha_ref',
+    'zona': 'zona',
+    'inicio': 'inicio',
+    'fin': 'fin',
+    'tipo_tramo': 'tipo_tramo',
+    'sobrescritura': 'sobrescritura',
+}
+DATE_FORMATS = {
+    'fecha_ref': 'DD/MM/YYYY',
+    'inicio': 'DD/MM/YYYY HH:MM',
+    'fin': 'DD/MM/YYYY HH:MM',
+}
+
+
+# ═══════════════════════════════════════════════════
+# XML / ZIP — Preservar validaciones
+# ═══════════════════════════════════════════════════
+
+def extract_all_validations(file_bytes):
+    validations = {}
+    ns = '{' + SPREADSHEET_NS + '}'
+    with ZipFile(BytesIO(file_bytes), 'r') as zf:
+        for name in zf.namelist():
+            if name.startswith('xl/worksheets/') and name.endswith('.xml'):
+                tree = ET.fromstring(zf.read(name))
+                dv_node = tree.find(ns + 'dataValidations')
+                if dv_node is not None:
+                    validations[name] = ET.tostring(dv_node, encoding='unicode')
+    return validations
+
+
+def expand_sqref(sqref, max_row):
+    parts = sqref.split(' ')
+    new_parts = []
+    for part in parts:
+        if ':' in part:
+            start, end = part.split(':')
+            col_end = re.match(r'([A-Z]+)', end)
+            row_end = re.search(r'(\d+)', end)
+            if col_end and row_end:
+                old_row = int(row_end.group(1))
+                if max_row > old_row:
+                    new_parts.append(f"{start}:{col_end.group(1)}{max_row}")
+                else:
+                    new_parts.append(part)
+            else:
+                new_parts.append(part)
+        else:
+            new_parts.append(part)
+    return ' '.join(new_parts)
+
+
+# Presupuesto de memoria por fichero intermedio/salida: por encima se vuelca a disco
+SPOOL_MAX_BYTES = int(float(os.environ.get('ENDALIA_MEMORIA_MB', '64')) * 2 ** 20)
+
+
+def new_spool():
+    return tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES, prefix='endalia_')
+
+
+def _as_file(data):
+    # Acepta bytes/memoryview o un fichero con seek (BytesIO, spool...)
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return BytesIO(data)
+    data.seek(0)
+    return data
+
+
+def _finish(destino, buf):
+    # Sin destino se devuelven bytes, como hasta ahora; con destino, el propio fichero
+    return buf.getvalue() if destino is None else buf
+
+
+def leer_salida(salida, lock=None):
+    # Con `lock`, varias sesiones pueden leer a la vez la misma salida compartida
+    with lock if lock is not None else nullcontext():
+        salida.seek(0)
+        return salida.read()
+
+
+def _read_raw_member(zf, info):
+    # Datos comprimidos tal cual están en el zip, sin pasar por zlib
+    zf.fp.seek(info.header_offset)
+    header = zf.fp.read(30)
+    name_len, extra_len = struct.unpack('<HH', header[26:30])
+    zf.fp.seek(info.header_offset + 30 + name_len + extra_len)
+    return zf.fp.read(info.compress_size)
+
+
+def copy_member_raw(src_zip, dst_zip, info):
+    raw = _read_raw_member(src_zip, info)
+    zinfo = copy(info)
+    zinfo.flag_bits &= ~0x08  # CRC y tamaños ya van en la cabecera local
+    zinfo.extra = b''
+    _write_member_raw(dst_zip, zinfo, raw)
+
+
+def _write_member_raw(dst_zip, zinfo, raw):
+    zinfo.header_offset = dst_zip.fp.tell()
+    dst_zip.fp.write(zinfo.FileHeader())
+    dst_zip.fp.write(raw)
+    dst_zip.filelist.append(zinfo)
+    dst_zip.NameToInfo[zinfo.filename] = zinfo
+    dst_zip.start_dir = dst_zip.fp.tell()
+
+
+# Parcheo en streaming: la hoja se recorre por bloques hasta cerrar sheetData
+# (lo voluminoso) y solo se analiza lo que viene detrás, que es pequeño
+PATCH_READ_SIZE = 1 << 20
+PATCH_CARRY = 4096  # solape entre bloques para no partir una etiqueta
+WORKSHEET_TAG_RE = re.compile(rb'<(?:[\w.-]+:)?worksheet\b[^>]*>')
+XMLNS_PREFIX_RE = re.compile(rb'\sxmlns:([\w.-]+)="[^"]*"')
+SHEETDATA_END_RE = re.compile(rb'</(?:[\w.-]+:)?sheetData\s*>|<(?:[\w.-]+:)?sheetData\b[^>]*/>')
+ROW_NUM_RE = re.compile(rb'<(?:[\w.-]+:)?row\b[^>]*?\sr="(\d+)"')
+TAG_RE = re.compile(rb'<(/?)(?:[\w.-]+:)?([\w.-]+)(?:\s+[^\s=>/]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*\s*(/?)>')
+SQREF_ATTR_RE = re.compile(rb'(<(?:[\w.-]+:)?dataValidation\b[^>]*?\bsqref=")([^"]*)(")')
+SHEET_INSERT_BEFORE = (b'pageMargins', b'pageSetup', b'headerFooter', b'drawing', b'legacyDrawing',
+                       b'tableParts', b'extLst')
+
+
+def _scan_sheet(fh, out=None, extra_ns=()):
+    # Devuelve (etiqueta <worksheet>, última fila, cola tras sheetData, encontrada).
+    # Con `out`, todo lo recorrido hasta el cierre de sheetData se copia allí, y
+    # a la etiqueta <worksheet> se le añaden las declaraciones de `extra_ns` que falten
+    pending = b''
+    root = None
+    max_row = None
+    while True:
+        chunk = fh.read(PATCH_READ_SIZE)
+        pending += chunk
+        if root is None:
+            m = WORKSHEET_TAG_RE.search(pending)
+            if m is None and chunk:
+                continue
+            if m is not None:
+                root = m.group(0)
+                declared = {d.group(1) for d in XMLNS_PREFIX_RE.finditer(root)}
+                extra = b''.join(ns for ns in extra_ns if XMLNS_PREFIX_RE.match(ns).group(1) not in declared)
+                if extra:
+                    cierre = m.end() - 1
+                    pending = pending[:cierre] + extra + pending[cierre:]
+        end = SHEETDATA_END_RE.search(pending)
+        if end is not None:
+            cut = end.end()
+        elif chunk:
+            cut = max(len(pending) - PATCH_CARRY, 0)
+        else:
+            cut = len(pending)
+        for r in ROW_NUM_RE.finditer(pending, 0, cut if end is not None else len(pending)):
+            num = int(r.group(1))
+            if max_row is None or num > max_row:
+                max_row = num
+        if out is not None:
+            out.write(pending[:cut])
+        if end is not None:
+            return root, max_row, pending[cut:] + fh.read(), True
+        if not chunk:
+            return root, max_row, b'', False
+        pending = pending[cut:]
+
+
+def _top_level_spans(tail):
+    # (nombre, inicio, fin) de cada hijo directo de <worksheet> en la cola; el
+    # cierre </worksheet> aparece como un hijo más para marcar dónde termina
+    spans = []
+    depth = 0
+    start = 0
+    for m in TAG_RE.finditer(tail):
+        closing, name, empty = m.groups()
+        if closing:
+            depth -= 1
+            if depth == 0:
+                spans.append((name, start, m.end()))
+            elif depth < 0:
+                spans.append((name, m.start(), m.end()))
+                break
+        elif empty:
+            if depth == 0:
+                spans.append((name, m.start(), m.end()))
+        else:
+            if depth == 0:
+                start = m.start()
+            depth += 1
+    return spans
+
+
+def scan_original_sheet(fh):
+    # Lo que hace falta de la hoja de la plantilla para parchear la de salida:
+    # las declaraciones de espacios de nombres de la raíz, dataValidations y extLst
+    root, _, tail, found = _scan_sheet(fh)
+    if not found:
+        return None
+    parts = {name: tail[a:b] for name, a, b in _top_level_spans(tail)}
+    dv, ext = parts.get(b'dataValidations'), parts.get(b'extLst')
+    if dv is None and ext is None:
+        return None
+    extra_ns = [m.group(0) for m in XMLNS_PREFIX_RE.finditer(root or b'')]
+    return {'extra_ns': extra_ns, 'dataValidations': dv, 'extLst': ext}
+
+
+def patch_sheet_stream(src, dst, original):
+    # Copia la hoja de salida de `src` a `dst` sustituyendo sus dataValidations y
+    # extLst por los de la plantilla (ver scan_original_sheet), con los sqref
+    # ampliados hasta la última fila escrita. Nunca se construye el árbol de la hoja
+    _, max_row, tail, found = _scan_sheet(src, dst, original['extra_ns'])
+    if not found:
+        return
+    dv, ext = original['dataValidations'], original['extLst']
+    if dv is not None and max_row is not None:
+        dv = SQREF_ATTR_RE.sub(
+            lambda m: m.group(1) + expand_sqref(m.group(2).decode('utf-8'), max_row).encode('utf-8') + m.group(3), dv)
+    spans = _top_level_spans(tail)
+    end = next((a for name, a, b in spans if name == b'worksheet'), len(tail))
+    pos = 0
+    for name, a, b in spans:
+        if name == b'worksheet':
+            break
+        if dv is not None and name in SHEET_INSERT_BEFORE:
+            dst.write(tail[pos:a] + dv)
+            pos = a
+            dv = None
+        if name == b'dataValidations' or (ext is not None and name == b'extLst'):
+            dst.write(tail[pos:a])
+            pos = b
+    dst.write(tail[pos:end])
+    if dv is not None:
+        dst.write(dv)
+    if ext is not None:
+        dst.write(ext)
+    dst.write(tail[end:])
+
+
+def patch_zip_with_validations(output_bytes, original_bytes, compresslevel=None, destino=None):
+    # Una sola pasada: solo se descomprimen y reescriben, en streaming, las hojas
+    # que tenían validaciones o extLst; el resto se copian comprimidos tal cual.
+    # `output_bytes` puede ser un fichero (spool) y el resultado ir a `destino`
+    result_buffer = BytesIO() if destino is None else destino
+    with ZipFile(_as_file(original_bytes), 'r') as original_zip, \
+            ZipFile(_as_file(output_bytes), 'r') as output_zip_in, \
+            ZipFile(result_buffer, 'w', ZIP_DEFLATED, compresslevel=compresslevel) as result_zip:
+        original_infos = {info.filename: info for info in original_zip.infolist()}
+        for info in output_zip_in.infolist():
+            item = info.filename
+            original_info = original_infos.pop(item, None)
+            if original_info is not None and item.startswith('xl/worksheets/') and item.endswith('.xml'):
+                with original_zip.open(original_info) as fh:
+                    original = scan_original_sheet(fh)
+                if original is not None:
+                    with output_zip_in.open(info) as src, result_zip.open(item, 'w', force_zip64=True) as dst:
+                        patch_sheet_stream(src, dst, original)
+                    continue
+            copy_member_raw(output_zip_in, result_zip, info)
+        for original_info in original_infos.values():
+            copy_member_raw(original_zip, result_zip, original_info)
+    return _finish(destino, result_buffer)
+
+
+# ═══════════════════════════════════════════════════
+# Tramos y registros de salida
+# ═══════════════════════════════════════════════════
+
+def _intern(val):
+    return sys.intern(val) if type(val) is str else val
+
+
+class Tramo:
+    # Un tramo de la exportación. Con __slots__ ocupa una fracción de lo que
+    # ocupaba el dict equivalente, y los textos repetidos se comparten
+    __slots__ = ('empleado', 'fecha', 'hora_inicio', 'hora_fin', 'tipo_tramo', 'nif', 'codigo')
+
+    def __init__(self, empleado, fecha=None, hora_inicio=None, hora_fin=None, tipo_tramo=None, nif=None,
+                 codigo=None):
+        self.empleado = _intern(empleado)
+        self.fecha = fecha
+        self.hora_inicio = hora_inicio
+        self.hora_fin = hora_fin
+        self.tipo_tramo = _intern(tipo_tramo)
+        self.nif = _intern(nif)
+        self.codigo = _intern(codigo)
+
+    def con_hora_fin(self, hora_fin):
+        return Tramo(self.empleado, self.fecha, self.hora_inicio, hora_fin, self.tipo_tramo, self.nif, self.codigo)
+
+    def __repr__(self):
+        return f"Tramo({self.empleado!r}, {self.fecha!r}, {self.hora_inicio!r}, {self.hora_fin!r})"
+
+
+class Registro:
+    # Una fila de la plantilla de salida. Los datos del empleado no se copian:
+    # se referencia su entrada del directorio. Zona y sobrescritura son fijas
+    __slots__ = ('emp', 'fecha_ref', 'inicio', 'fin', 'tipo_tramo', 'tramo')
+    zona = ZONA_DEFAULT
+    sobrescritura = SOBRESCRITURA_DEFAULT
+
+    def __init__(self, emp, fecha_ref, inicio, fin, tipo_tramo, tramo=None):
+        self.emp = emp
+        self.fecha_ref = fecha_ref
+        self.inicio = inicio
+        self.fin = fin
+        self.tipo_tramo = tipo_tramo
+        self.tramo = tramo  # índice del tramo de origen
+
+    @property
+    def nif(self):
+        return self.emp['nif']
+
+    @property
+    def codigo(self):
+        return self.emp['codigo']
+
+    @property
+    def nombre(self):
+        return self.emp['nombre']
+
+    def __reduce__(self):
+        # Las partes pueden escribirse en otros procesos: así el pickle no pasa por copyreg
+        return Registro, (self.emp, self.fecha_ref, self.inicio, self.fin, self.tipo_tramo, self.tramo)
+
+    def __repr__(self):
+        return f"Registro({self.nombre!r}, {self.inicio!r}, {self.fin!r})"
+
+
+# ═══════════════════════════════════════════════════
+# Utilidades
+# ═══════════════════════════════════════════════════
+
+def remove_accents(text):
+    nfkd = unicodedata.normalize('NFKD', text)
+    return ''.join(c for c in nfkd if not unicodedata.category(c).startswith('M'))
+
+
+@lru_cache(maxsize=65536)
+def normalize_name(name):
+    if name is None:
+        return ''
+    s = str(name).strip().lower()
+    s = remove_accents(s)
+    s = re.sub(r'\s+', ' ', s).strip()
+    return s
+
+
+def normalize_id(val):
+    if val is None:
+        return ''
+    if isinstance(val, float) and val.is_integer():
+        val = int(val)
+    return re.sub(r'[\s.\-]', '', str(val)).upper()
+
+
+def extract_time_part(val):
+    if val is None:
+        return None
+    if isinstance(val, time):
+        return val
+    if isinstance(val, datetime):
+        return val.time()
+    s = str(val).strip()
+    m = re.match(r'(\d{1,2}):(\d{2})', s)
+    if m:
+        return time(int(m.group(1)), int(m.group(2)))
+    return None
+
+
+def extract_date_part(val):
+    if val is None:
+        return None
+    if isinstance(val, datetime):
+        return val.date()
+    if isinstance(val, date):
+        return val
+    s = str(val).strip()
+    for fmt in ['%d/%m/%Y', '%Y-%m-%d', '%d-%m-%Y']:
+        try:
+            return datetime.strptime(s, fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+def combine_date_time(fecha_val, hora_val):
+    d = extract_date_part(fecha_val)
+    t = extract_time_part(hora_val)
+    if d is None or t is None:
+        return None
+    return datetime.combine(d, t)
+
+
+def fmt_time(val):
+    if val is None:
+        return ''
+    if isinstance(val, time):
+        return val.strftime('%H:%M')
+    if isinstance(val, datetime):
+        return val.strftime('%H:%M')
+    return str(val)
+
+
+def fmt_date(val):
+    if val is None:
+        return ''
+    if isinstance(val, (datetime, date)):
+        return val.strftime('%d/%m/%Y')
+    return str(val)
+
+
+def is_missing_hora_fin(hora_fin):
+    if hora_fin is None:
+        return True
+    if isinstance(hora_fin, time):
+        return hora_fin == time(0, 0)
+    if isinstance(hora_fin, datetime):
+        return hora_fin.hour == 0 and hora_fin.minute == 0
+    s = str(hora_fin).strip()
+    return s == '' or s in ('00:00', '0:00', '00:00:00')
+
+
+TRAMOS_KEYWORDS = {
+    'fecha': ['fecha'],
+    'hora_inicio': ['hora inicio'],
+    'hora_fin': ['hora fin'],
+    'tipo_tramo': ['tipo de tramo', 'tipo de tra', 'tipo tramo'],
+    'empleado': ['empleado'],
+}
+
+
+def map_tramos_columns(header):
+    col_map = {}
+    for idx, val in enumerate(header):
+        if val is None:
+            continue
+        val_lower = str(val).strip().lower()
+        # Las columnas identificativas no cuentan como 'empleado' ('Código empleado')
+        if 'doc. identificador' in val_lower or val_lower in ('nif', 'dni'):
+            col_map.setdefault('nif', idx)
+            continue
+        if 'codigo empleado' in val_lower or 'código empleado' in val_lower or val_lower in ('codigo', 'código'):
+            col_map.setdefault('codigo', idx)
+            continue
+        for key, terms in TRAMOS_KEYWORDS.items():
+            for term in terms:
+                if term in val_lower and key not in col_map:
+                    col_map[key] = idx
+                    break
+    return col_map
+
+
+def _iter_tramo_rows(rows, col_map):
+    emp_idx = col_map['empleado']
+    # Mismo orden que los argumentos de Tramo tras 'empleado'
+    extra = [col_map.get(key) for key in ['fecha', 'hora_inicio', 'hora_fin', 'tipo_tramo', 'nif', 'codigo']]
+    for values in rows:
+        n = len(values)
+        emp = values[emp_idx] if emp_idx < n else None
+        if emp is None or str(emp).strip() == '':
+            continue
+        yield Tramo(str(emp).strip(), *[values[idx] if idx is not None and idx < n else None for idx in extra])
+
+
+def iter_tramos(ws):
+    # Recorre la hoja fila a fila (válido con hojas read_only) sin materializarla
+    rows = ws.iter_rows(min_row=1, values_only=True)
+    header = next(rows, None) or ()
+    col_map = map_tramos_columns(header)
+    if 'empleado' not in col_map:
+        return None, "No se encontró la columna 'Empleado' en el archivo de registros."
+    return _iter_tramo_rows(rows, col_map), None
+
+
+def open_tramos_workbook(file_bytes):
+    return openpyxl.load_workbook(BytesIO(file_bytes), read_only=True, data_only=True)
+
+
+def read_tramos(wb):
+    tramos, error = iter_tramos(wb.active)
+    if error:
+        return None, error
+    return list(tramos), None
+
+
+# Exportaciones en CSV (reloj de fichajes) o Parquet (data lake): se leen por
+# columnas con pandas, mucho más rápido que celda a celda con openpyxl
+TRAMOS_FORMATOS = ['xlsx', 'csv', 'parquet']
+CSV_SNIFF_BYTES = 64 * 1024
+CSV_ENCODINGS = ['utf-8-sig', 'cp1252', 'latin-1']
+# Con BOM la codificación no se adivina (Excel "Texto Unicode" guarda UTF-16 LE con BOM)
+CSV_BOMS = [(codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16')]
+CSV_DELIMITERS = ';,\t|'
+
+
+def tramos_format(file_bytes):
+    if file_bytes[:4] == b'PAR1':
+        return 'parquet'
+    if file_bytes[:4] == b'PK\x03\x04':
+        return 'xlsx'
+    return 'csv'
+
+
+def sniff_csv(file_bytes):
+    # (codificación, separador) a partir del comienzo del archivo
+    sample = file_bytes[:CSV_SNIFF_BYTES]
+    for encoding in [enc for bom, enc in CSV_BOMS if sample.startswith(bom)][:1] or CSV_ENCODINGS:
+        try:
+            text = codecs.getincrementaldecoder(encoding)().decode(sample, final=False)
+            break
+        except UnicodeDecodeError:
+            continue
+    else:
+        raise ValueError(f"codificación no reconocida (probadas: {', '.join(CSV_ENCODINGS)})")
+    try:
+        delimiter = csv.Sniffer().sniff(text, delimiters=CSV_DELIMITERS).delimiter
+    except csv.Error:
+        header = text.split('\n', 1)[0]
+        delimiter = max(CSV_DELIMITERS, key=header.count)
+    return encoding, delimiter
+
+
+def read_tramos_frame(file_bytes, formato):
+    if formato == 'parquet':
+        return pd.read_parquet(BytesIO(file_bytes))
+    detectada, delimiter = sniff_csv(file_bytes)
+    # Si más adelante aparece un byte que no encaja, se prueba la siguiente codificación
+    # (con BOM no hay alternativa)
+    candidatas = CSV_ENCODINGS[CSV_ENCODINGS.index(detectada):] if detectada in CSV_ENCODINGS else [detectada]
+    for encoding in candidatas:
+        try:
+            return pd.read_csv(BytesIO(file_bytes), sep=delimiter, encoding=encoding, dtype=str,
+                               keep_default_na=False, na_values=[''])
+        except UnicodeDecodeError:
+            continue
+    raise ValueError(f"codificación no reconocida (probadas: {', '.join(candidatas)})")
+
+
+def _empleados_frame(df, idx):
+    # Nombres sin espacios alrededor; '' donde no hay empleado (esas filas se ignoran)
+    return df.iloc[:, idx].astype('string').str.strip().fillna('')
+
+
+def _columna_frame(df, col_map, key, filas):
+    # Valores Python de la columna `key` en `filas`, con None en las celdas vacías
+    idx = col_map.get(key)
+    if idx is None:
+        return [None] * len(filas)
+    col = df.iloc[filas, idx].astype(object)
+    return col.where(col.notna(), None).tolist()
+
+
+def _tramos_frame(df, col_map, empleados, filas):
+    # Un Tramo por cada posición de `filas`; solo se convierten las columnas que se usan
+    columnas = [empleados.iloc[filas].tolist()]
+    columnas += [_columna_frame(df, col_map, key, filas)
+                 for key in ['fecha', 'hora_inicio', 'hora_fin', 'tipo_tramo', 'nif', 'codigo']]
+    return (Tramo(*valores) for valores in zip(*columnas))
+
+
+def tramos_pendientes_frame(df):
+    # Como _tramos_pendientes, pero el filtro se hace por columnas antes de crear
+    # ningún Tramo: solo se materializan los pendientes
+    col_map = map_tramos_columns(list(df.columns))
+    if 'empleado' not in col_map:
+        return None, "No se encontró la columna 'Empleado' en el archivo de registros."
+    empleados = _empleados_frame(df, col_map['empleado'])
+    con_empleado = empleados.ne('').to_numpy()
+    pendiente = con_empleado
+    if 'hora_fin' in col_map:
+        # Los valores distintos son pocos: se decide cada uno una vez con is_missing_hora_fin
+        fin = df.iloc[:, col_map['hora_fin']]
+        vacios = [v for v in fin.dropna().unique() if is_missing_hora_fin(v)]
+        pendiente = pendiente & (fin.isna() | fin.isin(vacios)).to_numpy()
+    tramos = _tramos_frame(df, col_map, empleados, pendiente.nonzero()[0])
+    # De los tramos con hora fin basta su horario: se pasan las columnas, sin crear Tramos
+    cerrados = (con_empleado & ~pendiente).nonzero()[0]
+    return {
+        'total': int(con_empleado.sum()),
+        'pendientes': list(tramos),
+        'cerrados': tramos_cerrados(empleados.iloc[cerrados].tolist(), *(
+            _columna_frame(df, col_map, key, cerrados) for key in ['nif', 'codigo', 'fecha', 'hora_inicio', 'hora_fin'])),
+    }, None
+
+
+def find_plantilla_columns(ws):
+    cols = {}
+    header = next(ws.iter_rows(min_row=HEADER_ROW, max_row=HEADER_ROW, values_only=True), ())
+    for col, val in enumerate(header, start=1):
+        if val is None:
+            continue
+        h = str(val).strip().lower()
+        if 'doc. identificador' in h or h == 'nif' or h == 'dni':
+            cols.setdefault('nif', col)
+        elif 'codigo empleado' in h or 'código empleado' in h:
+            cols.setdefault('codigo', col)
+        elif h == 'empleado':
+            cols.setdefault('empleado', col)
+        elif 'fecha de referencia' in h:
+            cols.setdefault('fecha_ref', col)
+        elif 'zona horaria' in h:
+            cols.setdefault('zona', col)
+        elif h == 'inicio':
+            cols.setdefault('inicio', col)
+        elif h == 'fin':
+            cols.setdefault('fin', col)
+        elif 'tipo de tramo' in h:
+            cols.setdefault('tipo_tramo', col)
+        elif 'sobrescritura' in h:
+            cols.setdefault('sobrescritura', col)
+    return cols
+
+
+# ═══════════════════════════════════════════════════
+# Fechas y horas por columnas
+# ═══════════════════════════════════════════════════
+
+DATE_INPUT_FORMATS = ['%d/%m/%Y', '%Y-%m-%d', '%d-%m-%Y']
+FORMAT_SAMPLE_SIZE = 200
+
+
+def _value_kinds(series):
+    kinds = series.map(type)
+    return {
+        'str': kinds == str,
+        'datetime': kinds.isin([datetime, pd.Timestamp]),
+        'date': kinds == date,
+        'time': kinds == time,
+        'none': series.isna(),
+    }
+
+
+def _split_strings(series, kinds):
+    # Textos sin espacios alrededor y aparte los que quedan vacíos (no cuentan como error)
+    strings = series[kinds['str']].str.strip()
+    blank = strings == ''
+    return strings[~blank], kinds['none'] | series.index.isin(strings.index[blank])
+
+
+def _detect_date_format(strings):
+    sample = strings.head(FORMAT_SAMPLE_SIZE)
+    return max(DATE_INPUT_FORMATS,
+               key=lambda fmt: pd.to_datetime(sample, format=fmt, errors='coerce').notna().sum())
+
+
+def parse_date_column(values):
+    # Devuelve (fechas datetime64 a medianoche, índices en formato mixto, índices no válidos).
+    # El formato de texto se decide una vez por columna con una muestra
+    series = pd.Series(values, dtype=object)
+    kinds = _value_kinds(series)
+    result = pd.Series(pd.NaT, index=series.index, dtype='datetime64[ns]')
+    objs = kinds['datetime'] | kinds['date']
+    if objs.any():
+        result[objs] = pd.to_datetime(series[objs]).dt.normalize()
+    strings, blank = _split_strings(series, kinds)
+    mixed = pd.Index([])
+    if len(strings):
+        fmt = _detect_date_format(strings)
+        parsed = pd.to_datetime(strings, format=fmt, errors='coerce')
+        for other in DATE_INPUT_FORMATS:
+            pending = parsed.isna()
+            if other == fmt or not pending.any():
+                continue
+            retry = pd.to_datetime(strings[pending], format=other, errors='coerce')
+            parsed[pending] = retry
+            mixed = mixed.union(retry.index[retry.notna()])
+        result[parsed.index] = parsed
+    return result, mixed, result.index[result.isna() & ~blank]
+
+
+def parse_time_column(values):
+    # Devuelve (horas como timedelta64 desde medianoche, índices no válidos)
+    series = pd.Series(values, dtype=object)
+    kinds = _value_kinds(series)
+    result = pd.Series(pd.NaT, index=series.index, dtype='timedelta64[ns]')
+    if kinds['time'].any():
+        seconds = [t.hour * 3600 + t.minute * 60 + t.second for t in series[kinds['time']]]
+        result[kinds['time']] = pd.to_timedelta(seconds, unit='s')
+    if kinds['datetime'].any():
+        stamps = pd.to_datetime(series[kinds['datetime']])
+        result[kinds['datetime']] = stamps - stamps.dt.normalize()
+    strings, blank = _split_strings(series, kinds)
+    if len(strings):
+        parts = strings.str.extract(r'^(\d{1,2}):(\d{2})').astype(float)
+        ok = parts[0].le(23) & parts[1].le(59)
+        result[parts.index[ok]] = pd.to_timedelta(parts[0][ok] * 3600 + parts[1][ok] * 60, unit='s')
+    return result, result.index[result.isna() & ~blank]
+
+
+def _as_python(series, as_date=False):
+    stamps = pd.DatetimeIndex(series)
+    values = stamps.date if as_date else stamps.to_pydatetime()
+    return [v if ok else None for v, ok in zip(values.tolist(), stamps.notna())]
+
+
+def _rechazo(fila, tramo, campo, key, motivo):
+    return {
+        'fila': fila,
+        'empleado': tramo.empleado,
+        'campo': campo,
+        'valor': str(getattr(tramo, key)),
+        'motivo': motivo,
+    }
+
+
+def parse_tramos_fechas(tramos):
+    fechas, mixed, bad_fecha = parse_date_column([t.fecha for t in tramos])
+    inicio_td, bad_inicio = parse_time_column([t.hora_inicio for t in tramos])
+    fin_td, bad_fin = parse_time_column([t.hora_fin for t in tramos])
+
+    rechazos = []
+    for campo, key, indices, motivo in [
+        ('Fecha', 'fecha', mixed, 'Formato mixto'),
+        ('Fecha', 'fecha', bad_fecha, 'Valor no válido'),
+        ('Hora inicio', 'hora_inicio', bad_inicio, 'Valor no válido'),
+        ('Hora fin', 'hora_fin', bad_fin, 'Valor no válido'),
+    ]:
+        rechazos.extend(_rechazo(int(i), tramos[i], campo, key, motivo) for i in indices)
+    rechazos.sort(key=lambda r: r['fila'])
+    return {
+        'fecha': _as_python(fechas, as_date=True),
+        'inicio': _as_python(fechas + inicio_td),
+        'fin': _as_python(fechas + fin_td),
+        'rechazos': rechazos,
+    }
+
+
+# ═══════════════════════════════════════════════════
+# Motor de conciliación
+# ═══════════════════════════════════════════════════
+
+def get_template_sheet(wb):
+    if TEMPLATE_SHEET in wb.sheetnames:
+        return wb[TEMPLATE_SHEET]
+    return wb.active
+
+
+def read_plantilla_empleados(ws, cols):
+    emp_idx = cols['empleado'] - 1
+    nif_idx = cols.get('nif', 1) - 1
+    codigo_idx = cols.get('codigo', 2) - 1
+    plantilla_emps = []
+    for values in ws.iter_rows(min_row=HEADER_ROW + 1, values_only=True):
+        emp_val = values[emp_idx] if emp_idx < len(values) else None
+        if emp_val is None or str(emp_val).strip() == '':
+            continue
+        plantilla_emps.append({
+            'nombre': str(emp_val).strip(),
+            'nombre_norm': normalize_name(emp_val),
+            'nif': values[nif_idx] if nif_idx < len(values) else None,
+            'codigo': values[codigo_idx] if codigo_idx < len(values) else None,
+        })
+    return plantilla_emps
+
+
+def read_directorio(ws):
+    cols = find_plantilla_columns(ws)
+    if 'empleado' not in cols:
+        return None, "No se encontró la columna 'Empleado' en la plantilla."
+    plantilla_emps = read_plantilla_empleados(ws, cols)
+    directorio = build_directorio(plantilla_emps, 'nif' in cols, 'codigo' in cols)
+    directorio['cols'] = cols
+    return directorio, None
+
+
+# ═══════════════════════════════════════════════════
+# Índice de empleados
+# ═══════════════════════════════════════════════════
+
+FUZZY_MIN_SCORE = 0.5
+FUZZY_MARGIN = 0.05
+# Un nombre parecido solo se asigna solo por encima de esto (erratas en nombres
+# largos); "Juan/José Martínez Ruiz" rondan 0.74. Por debajo se propone y se confirma
+FUZZY_AUTO_SCORE = 0.9
+
+
+def name_ngrams(name_norm, n=3):
+    padded = ' ' * (n - 1) + name_norm + ' '
+    return frozenset(padded[i:i + n] for i in range(len(padded) - n + 1))
+
+
+def name_tokens(name_norm):
+    # Las palabras del nombre sin orden ni puntuación: "ruiz martinez, juan" == "juan martinez ruiz"
+    return tuple(sorted(re.findall(r'\w+', name_norm)))
+
+
+def name_similarity(a_norm, b_norm):
+    a, b = name_ngrams(a_norm), name_ngrams(b_norm)
+    return 2 * len(a & b) / (len(a) + len(b)) if a or b else 0.0
+
+
+def build_directorio(plantilla_emps, con_nif=True, con_codigo=True):
+    por_nif = {}
+    por_codigo = {}
+    por_tokens = {}
+    ngramas = {}
+    ngramas_len = []
+    for pos, pe in enumerate(plantilla_emps):
+        if con_nif and normalize_id(pe['nif']):
+            por_nif.setdefault(normalize_id(pe['nif']), pe)
+        if con_codigo and normalize_id(pe['codigo']):
+            por_codigo.setdefault(normalize_id(pe['codigo']), pe)
+        # Dos empleados con las mismas palabras no se distinguen: ninguno casa así
+        tokens = name_tokens(pe['nombre_norm'])
+        por_tokens[tokens] = pe if tokens not in por_tokens else None
+        grams = name_ngrams(pe['nombre_norm'])
+        ngramas_len.append(len(grams))
+        for g in grams:
+            ngramas.setdefault(g, []).append(pos)
+    return {
+        'empleados': plantilla_emps,
+        'index': {pe['nombre_norm']: pe for pe in plantilla_emps},
+        'por_nif': por_nif,
+        'por_codigo': por_codigo,
+        'por_tokens': por_tokens,
+        'con_nif': con_nif,
+        'con_codigo': con_codigo,
+        'ngramas': ngramas,
+        'ngramas_len': ngramas_len,
+        'alias': {},
+    }
+
+
+def match_candidates(directorio, nombre_norm, limit=5, min_score=FUZZY_MIN_SCORE):
+    # El índice invertido de n-gramas solo visita empleados que comparten algún
+    # n-grama con la consulta; el recuento de solapes se hace en C con Counter
+    query = name_ngrams(nombre_norm)
+    if not query:
+        return []
+    ngramas = directorio['ngramas']
+    overlaps = Counter()
+    for g in query:
+        overlaps.update(ngramas.get(g, ()))
+    sizes = directorio['ngramas_len']
+    # Con Dice >= min_score hace falta un solape mínimo, independiente del candidato
+    needed = ceil(min_score * len(query) / (2 - min_score))
+    scored = []
+    for pos, common in overlaps.items():
+        if common < needed:
+            continue
+        score = 2 * common / (len(query) + sizes[pos])
+        if score >= min_score:
+            scored.append((score, pos))
+    scored.sort(key=lambda x: (-x[0], x[1]))
+    return [(score, directorio['empleados'][pos]) for score, pos in scored[:limit]]
+
+
+def resolve_employee(directorio, nombre_norm, nif=None, codigo=None):
+    # Devuelve (empleado, aproximada). `aproximada` es (similitud, candidato) si
+    # el nombre no casa tal cual: con empleado, se ha asignado por parecido; sin
+    # él, es una propuesta que el usuario tiene que confirmar (alias)
+    nif_norm = normalize_id(nif)
+    if nif_norm and nif_norm in directorio['por_nif']:
+        return directorio['por_nif'][nif_norm], None
+    codigo_norm = normalize_id(codigo)
+    if codigo_norm and codigo_norm in directorio['por_codigo']:
+        return directorio['por_codigo'][codigo_norm], None
+    # Un NIF o código que la plantilla no tiene no se suple con el nombre: sería
+    # otra persona que se llama igual o parecido. Solo vale una asignación manual
+    id_sin_casar = (nif_norm and directorio['con_nif']) or (codigo_norm and directorio['con_codigo'])
+    if not id_sin_casar:
+        found = directorio['index'].get(nombre_norm)
+        if found is not None:
+            return found, None
+    # Asignaciones manuales guardadas para nombres que no casaban
+    found = directorio['alias'].get(nombre_norm)
+    if found is not None or id_sin_casar:
+        return found, None
+    found = directorio['por_tokens'].get(name_tokens(nombre_norm))
+    if found is not None:
+        return found, (name_similarity(nombre_norm, found['nombre_norm']), found)
+    candidates = match_candidates(directorio, nombre_norm, limit=2)
+    if not candidates:
+        return None, None
+    # Si los dos mejores empatan no hay forma de decidir: ni se asigna ni se propone
+    if len(candidates) > 1 and candidates[0][0] - candidates[1][0] < FUZZY_MARGIN:
+        return None, None
+    score, found = candidates[0]
+    return (found if score >= FUZZY_AUTO_SCORE else None), (score, found)
+
+
+def clave_empleado(nombre, nif, codigo):
+    # Agrupa los tramos de un mismo empleado antes de buscarlo (resolve_employee)
+    return normalize_name(nombre), normalize_id(nif), normalize_id(codigo)
+
+
+def conciliar_tramos(tramos, directorio, fechas=None, progreso=None):
+    plantilla_emps = directorio['empleados']
+    if fechas is None:
+        fechas = parse_tramos_fechas(tramos)
+
+    tramos_by_emp = {}
+    for i, t in enumerate(tramos):
+        key = clave_empleado(t.empleado, t.nif, t.codigo)
+        if key not in tramos_by_emp:
+            tramos_by_emp[key] = []
+        tramos_by_emp[key].append(i)
+
+    output_rows = []
+    matched_ids = set()
+    unmatched = []
+    aproximadas = {}
+
+    procesados = 0
+    for (tramo_norm, nif, codigo), emp_tramos in tramos_by_emp.items():
+        if progreso is not None:
+            progreso.avanzar('conciliar', procesados, len(tramos))
+            procesados += len(emp_tramos)
+        found, aproximada = resolve_employee(directorio, tramo_norm, nif, codigo)
+        if aproximada is not None:
+            nombre = tramos[emp_tramos[0]].empleado
+            if nombre in aproximadas:
+                aproximadas[nombre]['tramos'] += len(emp_tramos)
+            else:
+                aproximadas[nombre] = _aproximada(nombre, *aproximada, found is not None, len(emp_tramos))
+        if found is None:
+            for i in emp_tramos:
+                unmatched.append(tramos[i].empleado)
+            continue
+
+        matched_ids.add(id(found))
+        for i in emp_tramos:
+            output_rows.append(Registro(found, fechas['fecha'][i], fechas['inicio'][i], fechas['fin'][i],
+                                        tramos[i].tipo_tramo, i))
+
+    removed = sum(1 for pe in plantilla_emps if id(pe) not in matched_ids)
+    return output_rows, list(set(unmatched)), removed, sorted(aproximadas.values(), key=lambda a: a['empleado'])
+
+
+def _aproximada(nombre, similitud, candidato, asignado, tramos):
+    return {
+        'empleado': nombre,
+        'candidato': candidato['nombre'],
+        'nif': candidato['nif'],
+        'similitud': round(similitud, 2),
+        'asignado': asignado,
+        'tramos': tramos,
+    }
+
+
+def _incidencia(r, motivo, otro=None, horario=None):
+    # `otro`: la fila exportada con la que choca; `horario`: (inicio, fin) de un tramo cerrado
+    if otro is not None:
+        horario = (otro.inicio, otro.fin)
+    return {
+        'fila': r.tramo,
+        'empleado': r.nombre,
+        'fecha': fmt_date(r.fecha_ref),
+        'inicio': fmt_time(r.inicio),
+        'fin': fmt_time(r.fin),
+        'motivo': motivo,
+        'con_fila': otro.tramo if otro is not None else None,
+        'con_horario': f"{fmt_time(horario[0])}–{fmt_time(horario[1])}" if horario is not None else '',
+    }
+
+
+def tramos_cerrados(nombres=(), nifs=(), codigos=(), fechas=(), inicios=(), fines=()):
+    # Horario de los tramos que ya tenían hora fin (una columna por argumento),
+    # agrupado por clave_empleado: {clave: [(fecha, inicio, fin)]}. Los que no se
+    # pueden interpretar, o no duran nada, no pueden solapar con nada y se descartan
+    if not len(nombres):
+        return {}
+    memo = {}
+    claves = [memo[k] if k in memo else memo.setdefault(k, clave_empleado(*k))
+              for k in zip(nombres, nifs, codigos)]
+    dias, _, _ = parse_date_column(fechas)
+    inicio = dias + parse_time_column(inicios)[0]
+    fin = dias + parse_time_column(fines)[0]
+    validos = (fin > inicio).to_numpy()
+    cerrados = {}
+    for clave, dia, ini, fn in zip(compress(claves, validos), _as_python(dias[validos], as_date=True),
+                                   _as_python(inicio[validos]), _as_python(fin[validos])):
+        cerrados.setdefault(clave, []).append((dia, ini, fn))
+    return cerrados
+
+
+def contexto_cerrados(cerrados, directorio):
+    # {(id del empleado, fecha): (inicios, fines)} con los empleados de la plantilla.
+    # Los tramos cerrados de cada grupo se funden en intervalos disjuntos y
+    # ordenados: las dos listas quedan ordenadas y se pueden buscar con bisect
+    grupos = {}
+    for clave, horarios in cerrados.items():
+        emp, _ = resolve_employee(directorio, *clave)
+        if emp is None:
+            continue
+        for fecha, inicio, fin in horarios:
+            grupos.setdefault((id(emp), fecha), []).append((inicio, fin))
+    contexto = {}
+    for clave, horarios in grupos.items():
+        horarios.sort()
+        inicios, fines = [], []
+        for inicio, fin in horarios:
+            if fines and inicio < fines[-1]:
+                fines[-1] = max(fines[-1], fin)
+            else:
+                inicios.append(inicio)
+                fines.append(fin)
+        contexto[clave] = (inicios, fines)
+    return contexto
+
+
+def detectar_incidencias(output_rows, claves=None, contexto=None):
+    # Endalia rechaza la importación entera si un empleado tiene tramos que se
+    # solapan. Índice de intervalos por (empleado, fecha): cada grupo se ordena
+    # por inicio y se recorre una vez comparando con el tramo que llega más lejos.
+    # Con `contexto` (contexto_cerrados), cada fila se compara además con los
+    # tramos ya cerrados del archivo, que no se exportan ni generan avisos propios.
+    # Devuelve {(id del empleado, fecha): [incidencias]}; con `claves`, solo esos grupos
+    contexto = contexto or {}
+    grupos = {}
+    for r in output_rows:
+        if r.inicio is None or r.fin is None:  # ya figuran entre los rechazos
+            continue
+        clave = (id(r.emp), r.fecha_ref)
+        if claves is None or clave in claves:
+            grupos.setdefault(clave, []).append(r)
+    por_grupo = {}
+    for clave, tramos_dia in grupos.items():
+        incidencias = [_incidencia(r, 'Duración nula' if r.fin == r.inicio else 'Duración negativa')
+                       for r in tramos_dia if r.fin <= r.inicio]
+        validos = [r for r in tramos_dia if r.fin > r.inicio] if incidencias else tramos_dia
+        avisadas = set()
+        if len(validos) > 1:
+            validos.sort(key=attrgetter('inicio', 'fin'))
+            anterior = alcance = validos[0]
+            for r in validos[1:]:
+                if r.inicio == anterior.inicio and r.fin == anterior.fin and r.tipo_tramo == anterior.tipo_tramo:
+                    incidencias.append(_incidencia(r, 'Duplicado', anterior))
+                    avisadas.add(id(r))
+                elif r.inicio < alcance.fin:
+                    incidencias.append(_incidencia(r, 'Solape', alcance))
+                    avisadas.add(id(r))
+                if r.fin > alcance.fin:
+                    alcance = r
+                anterior = r
+        if clave in contexto:
+            # Primer intervalo cerrado que acaba después del inicio: solapa si empieza antes del fin
+            inicios, fines = contexto[clave]
+            for r in validos:
+                k = bisect_right(fines, r.inicio)
+                if k < len(inicios) and inicios[k] < r.fin and id(r) not in avisadas:
+                    incidencias.append(_incidencia(r, 'Solape con tramo cerrado', horario=(inicios[k], fines[k])))
+        if incidencias:
+            por_grupo[clave] = incidencias
+    return por_grupo
+
+
+def lista_incidencias(por_grupo):
+    return sorted((i for incidencias in por_grupo.values() for i in incidencias),
+                  key=lambda i: (i['fila'] is None, i['fila']))
+
+
+def conciliar(wb_template, tramos, directorio=None, fechas=None):
+    ws = get_template_sheet(wb_template)
+
+    cols = find_plantilla_columns(ws)
+    if 'empleado' not in cols:
+        return None, None, None, "No se encontró la columna 'Empleado' en la plantilla."
+
+    if directorio is None:
+        directorio, _ = read_directorio(ws)
+    output_rows, unmatched, removed, _ = conciliar_tramos(tramos, directorio, fechas)
+    write_rows_openpyxl(ws, cols, output_rows)
+    return output_rows, unmatched, removed, None
+
+
+def write_rows_openpyxl(ws, cols, output_rows, progreso=None):
+    # Estilo de cada columna (con su formato de fecha) resuelto una sola vez desde
+    # la primera fila de datos; cada celda nueva recibe una copia del StyleArray
+    # (índices a los estilos ya registrados) en vez de copiar fuente, borde, relleno...
+    style_row = HEADER_ROW + 1
+    max_col = ws.max_column
+    col_styles = {}
+    for c in range(1, max_col + 1):
+        src = ws.cell(row=style_row, column=c)
+        key = next((k for k, col in cols.items() if col == c and k in DATE_FORMATS), None)
+        if not src.has_style and key is None:
+            continue
+        style = Cell(ws, style_array=src._style if src.has_style else None)
+        if key is not None:
+            style.number_format = DATE_FORMATS[key]
+        col_styles[c] = style._style
+    fields = [(cols[key], field) for key, field in OUTPUT_FIELDS.items() if key in cols]
+
+    for row in range(HEADER_ROW + 1, ws.max_row + 1):
+        for c in range(1, max_col + 1):
+            ws.cell(row=row, column=c).value = None
+
+    for i, item in enumerate(output_rows):
+        if progreso is not None and i % WRITE_CHUNK_ROWS == 0:
+            progreso.avanzar('escritura', i, len(output_rows))
+        row = HEADER_ROW + 1 + i
+        for c, style in col_styles.items():
+            ws.cell(row=row, column=c)._style = copy(style)
+        for c, field in fields:
+            ws.cell(row=row, column=c).value = getattr(item, field)
+
+
+def write_openpyxl_plantilla(plantilla_bytes, output_rows, progreso=None, destino=None):
+    wb = openpyxl.load_workbook(BytesIO(plantilla_bytes), data_only=False)
+    ws = get_template_sheet(wb)
+    write_rows_openpyxl(ws, find_plantilla_columns(ws), output_rows, progreso)
+    if progreso is not None:
+        progreso.avanzar('guardar')
+    with new_spool() as guardado:
+        wb.save(guardado)
+        del wb, ws
+        if progreso is not None:
+            progreso.avanzar('patch_zip')
+        return patch_zip_with_validations(guardado, plantilla_bytes, destino=destino)
+
+
+# ═══════════════════════════════════════════════════
+# Escritura directa XLSX
+# ═══════════════════════════════════════════════════
+
+REL_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+PKG_REL_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+ROW_RE = re.compile(r'<row\b([^>]*?)(?:/>|>(.*?)</row>)', re.S)
+CELL_RE = re.compile(r'<c\b([^>]*?)(?:/>|>.*?</c>)', re.S)
+ATTR_RE = re.compile(r'([\w:]+)="([^"]*)"')
+XF_RE = re.compile(r'<xf\b[^>]*?(?:/>|>.*?</xf>)', re.S)
+NUMFMTS_RE = re.compile(r'<numFmts\b[^>]*?(?:/>|>(.*?)</numFmts>)', re.S)
+NUMFMT_RE = re.compile(r'<numFmt\b[^>]*?/>')
+ILLEGAL_XML_RE = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+WRITE_CHUNK_ROWS = 2000
+
+
+def _resolve_part(target, base='xl'):
+    if target.startswith('/'):
+        return target[1:]
+    return posixpath.normpath(posixpath.join(base, target))
+
+
+def _set_attr(tag_xml, name, value):
+    head, sep, rest = tag_xml.partition('>')
+    pattern = r'\b' + name + r'="[^"]*"'
+    if re.search(pattern, head):
+        head = re.sub(pattern, f'{name}="{value}"', head, count=1)
+    else:
+        head = re.sub(r'^(<[\w:]+)', rf'\1 {name}="{value}"', head, count=1)
+    return head + sep + rest
+
+
+def _split_cell_ref(ref):
+    m = re.match(r'([A-Z]+)(\d+)', ref)
+    return column_index_from_string(m.group(1)), int(m.group(2))
+
+
+def find_template_parts(zf):
+    ns = '{' + SPREADSHEET_NS + '}'
+    workbook = ET.fromstring(zf.read('xl/workbook.xml'))
+    rels = ET.fromstring(zf.read('xl/_rels/workbook.xml.rels'))
+    targets = {}
+    for rel in rels.findall('{' + PKG_REL_NS + '}Relationship'):
+        targets[rel.get('Id')] = (rel.get('Type', ''), _resolve_part(rel.get('Target', '')))
+    sheets = workbook.findall(f'{ns}sheets/{ns}sheet')
+    if not sheets:
+        raise ValueError("el libro no tiene hojas")
+    chosen = next((sh for sh in sheets if sh.get('name') == TEMPLATE_SHEET), None)
+    if chosen is None:
+        view = workbook.find(f'{ns}bookViews/{ns}workbookView')
+        active = int(view.get('activeTab', 0)) if view is not None else 0
+        chosen = sheets[active] if active < len(sheets) else sheets[0]
+    parts = {'sheet': targets[chosen.get('{' + REL_NS + '}id')][1]}
+    for rel_type, path in targets.values():
+        if rel_type.endswith('/styles'):
+            parts['styles'] = path
+        elif rel_type.endswith('/calcChain'):
+            parts['calc_chain'] = path
+    if 'styles' not in parts:
+        raise ValueError("la plantilla no tiene hoja de estilos")
+    return parts
+
+
+def _split_sheet_xml(sheet_xml):
+    m = re.search(r'<sheetData\b[^>]*?(/?)>', sheet_xml)
+    if m is None:
+        raise ValueError("no se encontró sheetData")
+    prefix = sheet_xml[:m.start()] + '<sheetData>'
+    if m.group(1):
+        return prefix, '', sheet_xml[m.end():]
+    end = sheet_xml.index('</sheetData>', m.end())
+    return prefix, sheet_xml[m.end():end], sheet_xml[end + len('</sheetData>'):]
+
+
+def _parse_template_rows(sheet_data):
+    rows = []
+    next_row = 1
+    for m in ROW_RE.finditer(sheet_data):
+        attrs = dict(ATTR_RE.findall(m.group(1)))
+        num = int(attrs.get('r', next_row))
+        next_row = num + 1
+        cells = []
+        next_col = 1
+        for cm in CELL_RE.finditer(m.group(2) or ''):
+            cattrs = dict(ATTR_RE.findall(cm.group(1)))
+            col = _split_cell_ref(cattrs['r'])[0] if 'r' in cattrs else next_col
+            next_col = col + 1
+            cells.append((col, int(cattrs.get('s', 0))))
+        rows.append((num, m.group(0), m.group(1), cells))
+    return rows
+
+
+def _patch_styles(styles_xml, base_styles):
+    # Añade a cellXfs una copia del estilo base de cada columna de fecha con su
+    # formato numérico, igual que hace `cell.number_format` en openpyxl
+    m = re.search(r'(<cellXfs\b[^>]*>)(.*?)(</cellXfs>)', styles_xml, re.S)
+    if m is None:
+        raise ValueError("no se encontró cellXfs")
+    xfs = XF_RE.findall(m.group(2))
+    nm = NUMFMTS_RE.search(styles_xml)
+    existing = {}
+    for tag in NUMFMT_RE.findall((nm.group(1) or '') if nm else ''):
+        attrs = dict(ATTR_RE.findall(tag))
+        existing[unescape(attrs.get('formatCode', ''), {'&quot;': '"', '&apos;': "'"})] = int(attrs['numFmtId'])
+    next_fmt = max([163] + list(existing.values())) + 1
+    new_fmts = []
+    new_xfs = []
+    derived = {}
+    date_styles = {}
+    for key, code in DATE_FORMATS.items():
+        if code not in existing:
+            existing[code] = next_fmt
+            new_fmts.append(f'<numFmt numFmtId="{next_fmt}" formatCode="{escape(code, {chr(34): "&quot;"})}"/>')
+            next_fmt += 1
+        base = base_styles.get(key, 0)
+        fmt_id = existing[code]
+        if (base, fmt_id) not in derived:
+            xf = xfs[base] if base < len(xfs) else '<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+            xf = _set_attr(_set_attr(xf, 'numFmtId', fmt_id), 'applyNumberFormat', 1)
+            derived[(base, fmt_id)] = len(xfs) + len(new_xfs)
+            new_xfs.append(xf)
+        date_styles[key] = derived[(base, fmt_id)]
+
+    open_tag = _set_attr(m.group(1), 'count', len(xfs) + len(new_xfs))
+    styles_xml = styles_xml[:m.start()] + open_tag + m.group(2) + ''.join(new_xfs) + m.group(3) + styles_xml[m.end():]
+    if new_fmts:
+        nm = NUMFMTS_RE.search(styles_xml)
+        if nm is not None:
+            fmts = NUMFMT_RE.findall(nm.group(1) or '') + new_fmts
+            block = f'<numFmts count="{len(fmts)}">' + ''.join(fmts) + '</numFmts>'
+            styles_xml = styles_xml[:nm.start()] + block + styles_xml[nm.end():]
+        else:
+            root = re.search(r'<styleSheet\b[^>]*>', styles_xml)
+            block = f'<numFmts count="{len(new_fmts)}">' + ''.join(new_fmts) + '</numFmts>'
+            styles_xml = styles_xml[:root.end()] + block + styles_xml[root.end():]
+    return styles_xml, date_styles
+
+
+def prepare_template(plantilla_bytes, cols):
+    # Deja la plantilla lista para volcar filas: todo lo que no es sheetData se
+    # copia tal cual, así que estilos, validaciones y extLst se conservan
+    try:
+        with ZipFile(BytesIO(plantilla_bytes), 'r') as zf:
+            parts = find_template_parts(zf)
+            sheet_xml = zf.read(parts['sheet']).decode('utf-8')
+            styles_xml = zf.read(parts['styles']).decode('utf-8')
+            replace = {}
+            drop = set()
+            if 'calc_chain' in parts and parts['calc_chain'] in zf.namelist():
+                # Las fórmulas de las filas originales desaparecen; Excel rehace la cadena
+                drop.add(parts['calc_chain'])
+                name = posixpath.basename(parts['calc_chain'])
+                replace['xl/_rels/workbook.xml.rels'] = re.sub(
+                    r'<Relationship\b[^>]*Target="[^"]*' + re.escape(name) + r'"[^>]*/>', '',
+                    zf.read('xl/_rels/workbook.xml.rels').decode('utf-8')).encode('utf-8')
+                replace['[Content_Types].xml'] = re.sub(
+                    r'<Override\b[^>]*PartName="/' + re.escape(parts['calc_chain']) + r'"[^>]*/>', '',
+                    zf.read('[Content_Types].xml').decode('utf-8')).encode('utf-8')
+
+        prefix, sheet_data, suffix = _split_sheet_xml(sheet_xml)
+        template_rows = _parse_template_rows(sheet_data)
+        max_col = max([c for _, _, _, cells in template_rows for c, _ in cells] + list(cols.values()) + [1])
+        base_row = {c: s for num, _, _, cells in template_rows if num == HEADER_ROW + 1 for c, s in cells}
+        base_styles = {key: base_row.get(col, 0) for key, col in cols.items()}
+        styles_xml, date_styles = _patch_styles(styles_xml, base_styles)
+    except (KeyError, ValueError, AttributeError, ET.ParseError, UnicodeDecodeError) as e:
+        return None, f"La plantilla no admite la escritura directa ({e})."
+
+    replace[parts['styles']] = styles_xml.encode('utf-8')
+    col_keys = {col: key for key, col in cols.items()}
+    plan = []
+    for c in range(1, max_col + 1):
+        key = col_keys.get(c)
+        style = date_styles[key] if key in date_styles else base_row.get(c, 0)
+        plan.append((get_column_letter(c), style, OUTPUT_FIELDS.get(key)))
+
+    blank_rows = []
+    for num, _, attrs, cells in template_rows:
+        if num > HEADER_ROW:
+            blank = ''.join(f'<c r="{get_column_letter(c)}{num}" s="{s}"/>' if s else '' for c, s in cells)
+            blank_rows.append((num, f'<row{attrs}>{blank}</row>'))
+
+    return {
+        'template_bytes': plantilla_bytes,
+        'sheet_path': parts['sheet'],
+        'prefix': prefix,
+        'header_rows': ''.join(xml for num, xml, _, _ in template_rows if num <= HEADER_ROW),
+        'blank_rows': blank_rows,
+        'suffix': suffix,
+        'plan': plan,
+        'last_col': get_column_letter(max_col),
+        'template_max_row': max([HEADER_ROW] + [num for num, _, _, _ in template_rows]),
+        'replace': replace,
+        'drop': drop,
+    }, None
+
+
+def _cell_xml(ref, style, value):
+    s_attr = f' s="{style}"' if style else ''
+    if value is None:
+        return f'<c r="{ref}"{s_attr}/>' if style else ''
+    if isinstance(value, bool):
+        return f'<c r="{ref}"{s_attr} t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (datetime, date, time)):
+        value = to_excel(value)
+    if isinstance(value, (int, float)):
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        return f'<c r="{ref}"{s_attr}><v>{value!r}</v></c>'
+    text = ILLEGAL_XML_RE.sub('', str(value))
+    space = ' xml:space="preserve"' if text != text.strip() else ''
+    return f'<c r="{ref}"{s_attr} t="inlineStr"><is><t{space}>{escape(text)}</t></is></c>'
+
+
+def render_row(prep, row_num, item):
+    cells = ''.join(_cell_xml(f'{letter}{row_num}', style, getattr(item, field) if field else None)
+                    for letter, style, field in prep['plan'])
+    return f'<row r="{row_num}">{cells}</row>'
+
+
+def render_chunk(prep, output_rows, k):
+    # Bloque k-ésimo de WRITE_CHUNK_ROWS filas, ya codificado
+    inicio = k * WRITE_CHUNK_ROWS
+    return ''.join(render_row(prep, HEADER_ROW + 1 + i, output_rows[i])
+                   for i in range(inicio, min(inicio + WRITE_CHUNK_ROWS, len(output_rows)))).encode('utf-8')
+
+
+def render_chunks(prep, output_rows, progreso=None):
+    for k in range(ceil(len(output_rows) / WRITE_CHUNK_ROWS)):
+        if progreso is not None:
+            progreso.avanzar('escritura', k * WRITE_CHUNK_ROWS, len(output_rows))
+        yield render_chunk(prep, output_rows, k)
+
+
+CRC32_POLY = 0xEDB88320
+
+
+def _crc_multmodp(a, b):
+    # Producto de polinomios módulo el de CRC-32 (como multmodp de zlib)
+    m = 1 << 31
+    p = 0
+    while True:
+        if a & m:
+            p ^= b
+            if a & (m - 1) == 0:
+                return p
+        m >>= 1
+        b = (b >> 1) ^ CRC32_POLY if b & 1 else b >> 1
+
+
+def _crc_x2n_table():
+    table = [1 << 30]
+    for _ in range(31):
+        table.append(_crc_multmodp(table[-1], table[-1]))
+    return table
+
+
+CRC32_X2N = _crc_x2n_table()
+
+
+def crc32_combine(crc1, crc2, len2):
+    # CRC de A+B a partir de crc(A), crc(B) y len(B), sin volver a leer los datos
+    # (crc32_combine de zlib, que el módulo zlib de Python no expone)
+    p = 1 << 31
+    k = 3
+    while len2:
+        if len2 & 1:
+            p = _crc_multmodp(CRC32_X2N[k & 31], p)
+        len2 >>= 1
+        k += 1
+    return _crc_multmodp(p, crc1) ^ crc2
+
+
+def deflate_chunk(xml, compresslevel=None):
+    # Segmento deflate autónomo: sin referencias a bloques anteriores y alineado
+    # a byte, así que los segmentos se pueden concatenar tal cual
+    c = zlib.compressobj(-1 if compresslevel is None else compresslevel, zlib.DEFLATED, -15)
+    return c.compress(xml) + c.flush(zlib.Z_FULL_FLUSH)
+
+
+def _sheet_head_tail(prep, n_rows):
+    last_output = HEADER_ROW + n_rows
+    max_row = max(last_output, prep['template_max_row'])
+    prefix = re.sub(r'<dimension\b[^>]*?/>', f'<dimension ref="A1:{prep["last_col"]}{max_row}"/>',
+                    prep['prefix'], count=1)
+    suffix = re.sub(r'(<dataValidation\b[^>]*?\bsqref=")([^"]*)(")',
+                    lambda m: m.group(1) + expand_sqref(m.group(2), max_row) + m.group(3),
+                    prep['suffix'])
+    head = prefix + prep['header_rows']
+    tail = ''.join(xml for num, xml in prep['blank_rows'] if num > last_output) + '</sheetData>' + suffix
+    return head.encode('utf-8'), tail.encode('utf-8')
+
+
+def _write_sheet(fh, prep, output_rows, progreso=None):
+    head, tail = _sheet_head_tail(prep, len(output_rows))
+    fh.write(head)
+    for chunk in render_chunks(prep, output_rows, progreso):
+        fh.write(chunk)
+    fh.write(tail)
+
+
+def render_chunk_deflated(prep, output_rows, k, compresslevel=None):
+    # Lo único que se guarda de cada bloque entre generaciones: CRC y tamaño del
+    # XML y su segmento comprimido. El XML en sí se descarta
+    xml = render_chunk(prep, output_rows, k)
+    return zlib.crc32(xml), len(xml), deflate_chunk(xml, compresslevel)
+
+
+def _write_sheet_precompressed(dst_zip, name, prep, output_rows, chunks, compresslevel=None):
+    # `chunks` = [render_chunk_deflated(...)]: solo se comprimen la cabecera y el
+    # final de la hoja, y el CRC total se combina a partir del de cada bloque
+    head, tail = _sheet_head_tail(prep, len(output_rows))
+    crc = zlib.crc32(head)
+    for chunk_crc, chunk_len, _ in chunks:
+        crc = crc32_combine(crc, chunk_crc, chunk_len)
+    crc = zlib.crc32(tail, crc)
+    final = zlib.compressobj(-1 if compresslevel is None else compresslevel, zlib.DEFLATED, -15)
+    raw = b''.join([deflate_chunk(head, compresslevel), *(z for _, _, z in chunks), final.compress(tail) + final.flush()])
+    zinfo = ZipInfo(name, date_time=localtime()[:6])
+    zinfo.compress_type = ZIP_DEFLATED
+    zinfo.external_attr = 0o600 << 16
+    zinfo.CRC = crc
+    zinfo.file_size = len(head) + sum(chunk_len for _, chunk_len, _ in chunks) + len(tail)
+    zinfo.compress_size = len(raw)
+    _write_member_raw(dst_zip, zinfo, raw)
+
+
+def write_streaming_plantilla(prep, output_rows, compresslevel=None, chunks=None, progreso=None, destino=None):
+    # `chunks`: filas ya renderizadas y comprimidas por bloques (generación incremental)
+    buf = BytesIO() if destino is None else destino
+    with ZipFile(BytesIO(prep['template_bytes']), 'r') as src, \
+            ZipFile(buf, 'w', ZIP_DEFLATED, compresslevel=compresslevel) as dst:
+        for info in src.infolist():
+            name = info.filename
+            if name in prep['drop']:
+                continue
+            if name == prep['sheet_path'] and chunks is not None:
+                _write_sheet_precompressed(dst, name, prep, output_rows, chunks, compresslevel)
+            elif name == prep['sheet_path']:
+                with dst.open(name, 'w') as fh:
+                    _write_sheet(fh, prep, output_rows, progreso)
+            elif name in prep['replace']:
+                dst.writestr(name, prep['replace'][name])
+            else:
+                copy_member_raw(src, dst, info)
+    return _finish(destino, buf)
+
+
+# ═══════════════════════════════════════════════════
+# Salida por partes
+# ═══════════════════════════════════════════════════
+
+PARTICIONES = {
+    'filas': "Por número de filas",
+    'mes': "Por mes",
+    'semana': "Por semana",
+    'empleados': "Por grupos de empleados",
+}
+# Procesos para escribir las partes. Por defecto uno (en este mismo proceso): con
+# ENDALIA_PARTES_WORKERS=N se reparten, nunca entre más núcleos de los disponibles
+PARTES_WORKERS = max(1, int(os.environ.get('ENDALIA_PARTES_WORKERS', '1')))
+# Por debajo de esto, mandar las filas a otros procesos cuesta más de lo que se gana
+PARTES_MIN_FILAS = 20000
+
+
+def partition_rows(output_rows, modo, limite=None):
+    # Devuelve [(etiqueta, filas)]. 'filas' y 'empleados' necesitan `limite`
+    # (filas por parte / empleados por parte); 'mes' y 'semana' usan fecha_ref
+    if modo == 'filas':
+        partes = [output_rows[i:i + limite] for i in range(0, len(output_rows), limite)]
+        etiquetadas = [(f'{n:03d}', filas) for n, filas in enumerate(partes, start=1)]
+    elif modo in ('mes', 'semana'):
+        grupos = {}
+        for r in output_rows:
+            f = r.fecha_ref
+            if f is None:
+                clave = 'sin_fecha'
+            elif modo == 'mes':
+                clave = f'{f:%Y-%m}'
+            else:
+                anio, semana, _ = f.isocalendar()
+                clave = f'{anio}-S{semana:02d}'
+            grupos.setdefault(clave, []).append(r)
+        etiquetadas = sorted(grupos.items())
+    elif modo == 'empleados':
+        # Todas las filas de un empleado van a la misma parte
+        por_emp = {}
+        for r in output_rows:
+            por_emp.setdefault(id(r.emp), []).append(r)
+        emps = list(por_emp.values())
+        etiquetadas = [(f'{n:03d}', [r for filas in emps[i:i + limite] for r in filas])
+                       for n, i in enumerate(range(0, len(emps), limite), start=1)]
+    else:
+        raise ValueError(f"Modo de partición desconocido: {modo!r}")
+    return etiquetadas or [('001', [])]
+
+
+def nucleos_disponibles():
+    # Los que este proceso puede usar de verdad (afinidad, cpuset), no los de la máquina
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _contexto_procesos():
+    # forkserver arranca los procesos desde un servidor limpio (sin los hilos de
+    # Streamlit) que, si lo encuentra en su ruta, ya tiene este módulo importado;
+    # spawn donde no existe
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context('forkserver')
+        ctx.set_forkserver_preload([__name__])
+        return ctx
+    return multiprocessing.get_context('spawn')
+
+
+_escritor_parte = None
+
+
+def _iniciar_proceso_partes(escribir):
+    # `escribir` (con la plantilla preparada) llega una vez por proceso, no con cada parte
+    global _escritor_parte
+    _escritor_parte = escribir
+
+
+def _escribir_parte(filas):
+    # Corre en un proceso aparte: la parte va a un fichero temporal y se devuelve
+    # su ruta, para no pasar la plantilla entera de vuelta por la tubería
+    fd, ruta = tempfile.mkstemp(prefix='endalia_', suffix='.xlsx')
+    try:
+        with open(fd, 'wb') as fh:
+            _escritor_parte(filas, destino=fh)
+    except BaseException:
+        os.remove(ruta)
+        raise
+    return ruta
+
+
+def _descartar_parte(future):
+    if not future.cancelled() and future.exception() is None:
+        os.remove(future.result())
+
+
+def write_partes_zip(partes, escribir, prefijo='endalia', workers=None, progreso=None, destino=None):
+    # Cada parte es una plantilla completa y se empaqueta sin recomprimir en el
+    # orden de `partes`. `escribir(filas, destino=...)` escribe una plantilla. El
+    # render es Python puro y no suelta el GIL: con varios workers y filas
+    # suficientes las partes se escriben en procesos aparte (`escribir` y las
+    # filas viajan por pickle)
+    workers = min(PARTES_WORKERS if workers is None else workers, nucleos_disponibles(), len(partes))
+    buf = BytesIO() if destino is None else destino
+    with ZipFile(buf, 'w', ZIP_STORED) as zf:
+        if workers > 1 and sum(len(filas) for _, filas in partes) >= PARTES_MIN_FILAS:
+            _write_partes_procesos(zf, partes, escribir, prefijo, workers, progreso)
+        else:
+            for n, (etiqueta, filas) in enumerate(partes, start=1):
+                with escribir(filas, destino=new_spool()) as spool, zf.open(f'{prefijo}_{etiqueta}.xlsx', 'w') as fh:
+                    spool.seek(0)
+                    shutil.copyfileobj(spool, fh)
+                if progreso is not None:
+                    progreso.avanzar('partes', n, len(partes))
+    return _finish(destino, buf)
+
+
+def _write_partes_procesos(zf, partes, escribir, prefijo, workers, progreso):
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=_contexto_procesos(),
+                               initializer=_iniciar_proceso_partes, initargs=(escribir,))
+    pendientes = [pool.submit(_escribir_parte, filas) for _, filas in partes]
+    try:
+        for n, (etiqueta, _) in enumerate(partes, start=1):
+            ruta = pendientes.pop(0).result()
+            try:
+                with open(ruta, 'rb') as src, zf.open(f'{prefijo}_{etiqueta}.xlsx', 'w') as fh:
+                    shutil.copyfileobj(src, fh)
+            finally:
+                os.remove(ruta)
+            if progreso is not None:
+                progreso.avanzar('partes', n, len(partes))
+    except BaseException:
+        # Las partes que ya se estaban escribiendo se borran al terminar
+        for future in pendientes:
+            future.add_done_callback(_descartar_parte)
+        raise
+    finally:
+        # Si se cancela, las partes que aún no han empezado no llegan a hacerse
+        pool.shutdown(cancel_futures=True)
+
+
+# ═══════════════════════════════════════════════════
+# Instrumentación
+# ═══════════════════════════════════════════════════
+
+logger = logging.getLogger('adaptador_endalia')
+# Nivel del log de etapas (una línea JSON por etapa en stderr), p. ej. ENDALIA_LOG=INFO.
+# `streamlit run` no configura este logger: sin esto, esas líneas se pierden
+LOG_NIVEL = os.environ.get('ENDALIA_LOG')
+
+
+def configurar_log(nivel):
+    if not logger.handlers:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.propagate = False
+    logger.setLevel(nivel.upper() if isinstance(nivel, str) else nivel)
+
+
+if LOG_NIVEL:
+    configurar_log(LOG_NIVEL)
+
+
+# tracemalloc es global al proceso: frena a todas las generaciones en curso y su
+# pico es uno solo. Se activa solo si la generación que lo pide es la única en
+# curso, y se apaga en cuanto empieza otra. Solo el hilo que lo activó lo lee
+_generaciones = {'en_curso': 0, 'trazador': None}
+_generaciones_lock = threading.Lock()
+
+
+@contextmanager
+def generacion_en_curso(trazar=False):
+    with _generaciones_lock:
+        _generaciones['en_curso'] += 1
+        if _generaciones['trazador'] is not None:
+            tracemalloc.stop()
+            _generaciones['trazador'] = None
+        elif trazar and _generaciones['en_curso'] == 1 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _generaciones['trazador'] = threading.get_ident()
+    try:
+        yield
+    finally:
+        with _generaciones_lock:
+            _generaciones['en_curso'] -= 1
+            if _generaciones['trazador'] == threading.get_ident():
+                tracemalloc.stop()
+                _generaciones['trazador'] = None
+
+
+@contextmanager
+def medir_etapa(nombre, metricas=None, **datos):
+    # Tiempo de pared y, si esta generación traza la memoria (generacion_en_curso),
+    # memoria pico de la etapa; si no, el RSS máximo del proceso.
+    # El bloque puede añadir contadores (filas, celdas...) al registro que recibe
+    registro = {'etapa': nombre, **datos}
+    yo = threading.get_ident()
+    with _generaciones_lock:
+        trazando = _generaciones['trazador'] == yo
+        if trazando:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+    inicio = perf_counter()
+    try:
+        yield registro
+    finally:
+        registro['segundos'] = round(perf_counter() - inicio, 4)
+        with _generaciones_lock:
+            # Si otra generación ha empezado entretanto, el trazado ya se ha apagado
+            trazando = trazando and _generaciones['trazador'] == yo
+            if trazando:
+                registro['pico_mb'] = round((tracemalloc.get_traced_memory()[1] - base) / 2 ** 20, 2)
+        if not trazando and resource is not None:
+            registro['rss_max_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        if metricas is not None:
+            metricas.append(registro)
+        logger.info(json.dumps(registro, ensure_ascii=False, default=str))
+
+
+class GeneracionCancelada(Exception):
+    pass
+
+
+class Progreso:
+    # Lo actualiza la generación en cada punto de control y lo lee la interfaz
+    # desde otro hilo. Tras cancelar(), el siguiente avanzar() lanza GeneracionCancelada
+    __slots__ = ('etapa', 'hechas', 'total', '_cancelar')
+
+    def __init__(self):
+        self.etapa = None
+        self.hechas = 0
+        self.total = 0
+        self._cancelar = threading.Event()
+
+    def avanzar(self, etapa, hechas=0, total=0):
+        if self._cancelar.is_set():
+            raise GeneracionCancelada()
+        self.etapa = etapa
+        self.hechas = hechas
+        self.total = total
+
+    def cancelar(self):
+        self._cancelar.set()
+
+    @property
+    def cancelado(self):
+        return self._cancelar.is_set()
+
+
+def perfil_a_bytes(perfil):
+    # Mismo formato que `Profile.dump_stats`: se abre con pstats o snakeviz
+    perfil.create_stats()
+    return marshal.dumps(perfil.stats)
+
+
+def resumen_perfil(perfil, limite=30):
+    salida = StringIO()
+    pstats.Stats(perfil, stream=salida).sort_stats('cumulative').print_stats(limite)
+    return salida.getvalue()
+
+
+# ═══════════════════════════════════════════════════
+# Pipeline (uso como librería / línea de comandos)
+# ═══════════════════════════════════════════════════
+
+HORA_FIN_DEFAULT = time(17, 0)
+
+
+def _tramos_pendientes(tramos_iter, error):
+    if error:
+        return None, error
+    # Solo se retienen los tramos pendientes; de los demás basta su horario
+    total = 0
+    tramos_sin_fin = []
+    cerrados = []
+    for t in tramos_iter:
+        total += 1
+        if is_missing_hora_fin(t.hora_fin):
+            tramos_sin_fin.append(t)
+        else:
+            cerrados.append((t.empleado, t.nif, t.codigo, t.fecha, t.hora_inicio, t.hora_fin))
+    return {'total': total, 'pendientes': tramos_sin_fin, 'cerrados': tramos_cerrados(*zip(*cerrados))}, None
+
+
+def parse_tramos_pendientes(tramos_bytes):
+    # Acepta xlsx, CSV o Parquet: el formato se reconoce por el contenido
+    formato = tramos_format(tramos_bytes)
+    if formato != 'xlsx':
+        try:
+            df = read_tramos_frame(tramos_bytes, formato)
+        except ImportError:
+            return None, "Para leer archivos Parquet hace falta instalar pyarrow."
+        except (ValueError, OSError) as e:
+            return None, f"No se pudo leer el archivo de registros ({formato}): {e}"
+        return tramos_pendientes_frame(df)
+    wb_tramos = open_tramos_workbook(tramos_bytes)
+    try:
+        return _tramos_pendientes(*iter_tramos(wb_tramos.active))
+    finally:
+        wb_tramos.close()
+
+
+def parse_directorio(plantilla_bytes):
+    wb = openpyxl.load_workbook(BytesIO(plantilla_bytes), read_only=True, data_only=True)
+    try:
+        return read_directorio(get_template_sheet(wb))
+    finally:
+        wb.close()
+
+
+def resolve_hora_fin(tramo, politica):
+    # `politica` es una hora fija (time) o una duración desde la hora de inicio (timedelta)
+    if isinstance(politica, timedelta):
+        inicio = extract_time_part(tramo.hora_inicio)
+        if inicio is None:
+            return None
+        fin = datetime.combine(date.min, inicio) + politica
+        return fin.time() if fin.date() == date.min else time(23, 59)
+    return politica
+
+
+def _escribir_salida(estado, output_rows, metricas=None, progreso=None):
+    prep, particion = estado['prep'], estado['particion']
+    with medir_etapa('escritura', metricas, motor='directo' if prep is not None else 'openpyxl') as m:
+        if prep is not None:
+            escribir = partial(write_streaming_plantilla, prep)
+            m['celdas'] = len(output_rows) * len(prep['plan'])
+        else:
+            # Plantillas con una estructura que no reconocemos: vía openpyxl
+            escribir = partial(write_openpyxl_plantilla, estado['plantilla_bytes'])
+        # La salida va a un spool: en memoria hasta SPOOL_MAX_BYTES y a disco a partir de ahí
+        salida = new_spool()
+        if particion is not None:
+            partes = partition_rows(output_rows, *particion)
+            write_partes_zip(partes, escribir, progreso=progreso, destino=salida)
+            m['partes'] = len(partes)
+        elif estado['chunks'] is not None:
+            partes = None
+            write_streaming_plantilla(prep, output_rows, chunks=estado['chunks'], destino=salida)
+        else:
+            partes = None
+            escribir(output_rows, progreso=progreso, destino=salida)
+        m['bytes'] = salida.seek(0, os.SEEK_END)
+    return salida, partes
+
+
+def generar_plantilla(tramos_completos, plantilla_bytes, directorio, metricas=None, particion=None, prep=None,
+                      incremental=False, progreso=None, delta=None, cerrados=None):
+    # `particion` = (modo, limite) genera un zip con una plantilla por parte.
+    # `prep` reutiliza un prepare_template ya hecho. Con `incremental`, el
+    # resultado guarda lo necesario para regenerar_plantilla. `progreso` (Progreso)
+    # recibe el avance y permite cancelar. `delta` = (origen, dato) deja solo las
+    # filas nuevas o cambiadas (ver DELTA_ORIGENES); no admite `incremental`, porque
+    # un cambio de hora puede meter o sacar filas de la salida. `cerrados`
+    # (tramos_cerrados) son los tramos del archivo que ya tenían hora fin
+    incremental = incremental and delta is None
+    if progreso is not None:
+        progreso.avanzar('fechas', 0, len(tramos_completos))
+    with medir_etapa('fechas', metricas, filas=len(tramos_completos)) as m:
+        fechas = parse_tramos_fechas(tramos_completos)
+        m['rechazos'] = len(fechas['rechazos'])
+    if prep is None:
+        with medir_etapa('preparar_plantilla', metricas) as m:
+            prep, _ = prepare_template(plantilla_bytes, directorio['cols'])
+            m['motor'] = 'directo' if prep is not None else 'openpyxl'
+    with medir_etapa('conciliar', metricas, empleados=len(directorio['empleados'])) as m:
+        output_rows, unmatched, removed, aproximadas = conciliar_tramos(tramos_completos, directorio, fechas,
+                                                                        progreso)
+        m['filas'] = len(output_rows)
+        m['no_encontrados'] = len(unmatched)
+        m['aproximadas'] = len(aproximadas)
+    if progreso is not None:
+        progreso.avanzar('validar')
+    with medir_etapa('validar', metricas, filas=len(output_rows)) as m:
+        contexto = contexto_cerrados(cerrados, directorio) if cerrados else {}
+        por_grupo = detectar_incidencias(output_rows, contexto=contexto)
+        incidencias = lista_incidencias(por_grupo)
+        m['incidencias'] = len(incidencias)
+    sin_cambios = None
+    if delta is not None:
+        with medir_etapa('delta', metricas, filas=len(output_rows)) as m:
+            output_rows, sin_cambios = filtrar_delta(output_rows, huellas_delta(delta, fechas), directorio['cols'])
+            m['sin_cambios'] = sin_cambios
+
+    estado = {'plantilla_bytes': plantilla_bytes, 'prep': prep, 'particion': particion, 'fechas': fechas,
+              'chunks': None}
+    if incremental:
+        # Posición de cada tramo en la salida y, si se escribe una sola hoja
+        # directamente, sus filas ya renderizadas y comprimidas por bloques
+        estado['fila_de'] = {r.tramo: pos for pos, r in enumerate(output_rows)}
+        estado['incidencias'] = por_grupo
+        estado['contexto'] = contexto
+        if prep is not None and particion is None:
+            with medir_etapa('renderizar', metricas, filas=len(output_rows)):
+                n_chunks = ceil(len(output_rows) / WRITE_CHUNK_ROWS)
+                with ThreadPoolExecutor(max_workers=PARTES_WORKERS) as pool:
+                    chunks = []
+                    for chunk in pool.map(partial(render_chunk_deflated, prep, output_rows), range(n_chunks)):
+                        if progreso is not None:
+                            progreso.avanzar('escritura', len(chunks) * WRITE_CHUNK_ROWS, len(output_rows))
+                        chunks.append(chunk)
+                    estado['chunks'] = chunks
+    salida, partes = _escribir_salida(estado, output_rows, metricas, progreso)
+    return {
+        'salida': salida,
+        'rows': output_rows,
+        'unmatched': unmatched,
+        'aproximadas': aproximadas,
+        'removed': removed,
+        'rechazos': fechas['rechazos'],
+        'incidencias': incidencias,
+        'sin_cambios': sin_cambios,
+        'partes': [(etiqueta, len(rows)) for etiqueta, rows in partes] if partes is not None else None,
+        'estado': estado if incremental else None,
+    }, None
+
+
+def regenerar_plantilla(anterior, cambios, metricas=None, progreso=None):
+    # Repite la generación `anterior` (mismas entradas, hecha con incremental=True)
+    # cambiando solo la hora fin de los tramos de `cambios` ({índice: tramo completo}).
+    # No modifica `anterior`: las listas que cambian se copian
+    if not cambios:
+        return dict(anterior), None
+    estado = dict(anterior['estado'])
+    fechas = estado['fechas']
+    indices = list(cambios)
+    if progreso is not None:
+        progreso.avanzar('fechas', 0, len(indices))
+    with medir_etapa('fechas', metricas, filas=len(indices)) as m:
+        # La fecha no cambia: se reutiliza la ya interpretada y solo se parsea la hora
+        fin_td, bad_fin = parse_time_column([cambios[i].hora_fin for i in indices])
+        dias = pd.Series(pd.to_datetime([fechas['fecha'][i] for i in indices]))
+        fin = list(fechas['fin'])
+        for i, valor in zip(indices, _as_python(dias + fin_td)):
+            fin[i] = valor
+        rechazos = [r for r in fechas['rechazos'] if not (r['campo'] == 'Hora fin' and r['fila'] in cambios)]
+        rechazos.extend(_rechazo(indices[k], cambios[indices[k]], 'Hora fin', 'hora_fin', 'Valor no válido')
+                        for k in bad_fin)
+        rechazos.sort(key=lambda r: r['fila'])
+        estado['fechas'] = dict(fechas, fin=fin, rechazos=rechazos)
+        m['rechazos'] = len(rechazos)
+    with medir_etapa('conciliar', metricas) as m:
+        output_rows = list(anterior['rows'])
+        tocadas = []
+        for i in indices:
+            pos = estado['fila_de'].get(i)
+            if pos is None:  # empleado no encontrado: no tiene fila
+                continue
+            r = output_rows[pos]
+            output_rows[pos] = Registro(r.emp, r.fecha_ref, r.inicio, fin[i], r.tipo_tramo, i)
+            tocadas.append(pos)
+        m['filas'] = len(tocadas)
+    if progreso is not None:
+        progreso.avanzar('validar')
+    with medir_etapa('validar', metricas) as m:
+        # Solo pueden cambiar los grupos (empleado, fecha) de las filas tocadas
+        claves = {(id(output_rows[pos].emp), output_rows[pos].fecha_ref) for pos in tocadas}
+        por_grupo = {k: v for k, v in estado['incidencias'].items() if k not in claves}
+        por_grupo.update(detectar_incidencias(output_rows, claves, estado['contexto']))
+        estado['incidencias'] = por_grupo
+        incidencias = lista_incidencias(por_grupo)
+        m['grupos'] = len(claves)
+        m['incidencias'] = len(incidencias)
+    if estado['chunks'] is not None:
+        with medir_etapa('renderizar', metricas) as m:
+            chunks = list(estado['chunks'])
+            bloques = {pos // WRITE_CHUNK_ROWS for pos in tocadas}
+            for k in bloques:
+                chunks[k] = render_chunk_deflated(estado['prep'], output_rows, k)
+            estado['chunks'] = chunks
+            m['bloques'] = len(bloques)
+    salida, partes = _escribir_salida(estado, output_rows, metricas, progreso)
+    return dict(
+        anterior,
+        salida=salida,
+        rows=output_rows,
+        rechazos=rechazos,
+        incidencias=incidencias,
+        partes=[(etiqueta, len(rows)) for etiqueta, rows in partes] if partes is not None else None,
+        estado=estado,
+    ), None
+
+
+def convertir(tramos_bytes, plantilla_bytes, politica=HORA_FIN_DEFAULT, metricas=None, particion=None, db_path=None,
+              delta=None):
+    # Con `db_path`, el directorio de empleados sale del almacén SQLite si ya se vio esa plantilla
+    with medir_etapa('read_tramos', metricas, bytes=len(tramos_bytes)) as m:
+        parsed, err = parse_tramos_pendientes(tramos_bytes)
+        if err:
+            return None, err
+        m['filas'] = parsed['total']
+        m['pendientes'] = len(parsed['pendientes'])
+    with medir_etapa('directorio', metricas, bytes=len(plantilla_bytes)) as m:
+        if db_path is not None:
+            directorio, err = parse_directorio_persistente(plantilla_bytes, db_path)
+        else:
+            directorio, err = parse_directorio(plantilla_bytes)
+        if err:
+            return None, err
+        m['empleados'] = len(directorio['empleados'])
+    tramos_completos = [t.con_hora_fin(resolve_hora_fin(t, politica)) for t in parsed['pendientes']]
+    resultado, err = generar_plantilla(tramos_completos, plantilla_bytes, directorio, metricas, particion,
+                                       delta=delta, cerrados=parsed['cerrados'])
+    if err:
+        return None, err
+    # Para save_huellas: quien escribe la salida la registra cuando ya está guardada
+    resultado['cols'] = directorio['cols']
+    resultado['total'] = parsed['total']
+    resultado['pendientes'] = len(tramos_completos)
+    return resultado, None
+
+
+# ═══════════════════════════════════════════════════
+# Directorio persistente (SQLite)
+# ═══════════════════════════════════════════════════
+
+DIRECTORIO_DB = os.environ.get('ENDALIA_DIRECTORIO_DB', 'directorio_endalia.sqlite3')
+# Cambiar si cambia normalize_name o el esquema: invalida los directorios guardados
+DIRECTORIO_DB_VERSION = 1
+DIRECTORIO_DB_MAX_PLANTILLAS = 20
+
+DIRECTORIO_SCHEMA = """
+CREATE TABLE IF NOT EXISTS plantillas (
+    clave TEXT PRIMARY KEY,
+    cols TEXT NOT NULL,
+    con_nif INTEGER NOT NULL,
+    con_codigo INTEGER NOT NULL,
+    usada REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS empleados (
+    clave TEXT NOT NULL REFERENCES plantillas (clave) ON DELETE CASCADE,
+    pos INTEGER NOT NULL,
+    nombre TEXT NOT NULL,
+    nombre_norm TEXT NOT NULL,
+    nif,
+    codigo,
+    PRIMARY KEY (clave, pos)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS alias (
+    nombre_norm TEXT PRIMARY KEY,
+    nombre TEXT NOT NULL,
+    emp_nombre TEXT NOT NULL,
+    emp_nif,
+    emp_codigo,
+    creado TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS exportados (
+    fecha TEXT NOT NULL,
+    empleado TEXT NOT NULL,
+    inicio TEXT NOT NULL,
+    huella BLOB NOT NULL,
+    exportado TEXT NOT NULL,
+    PRIMARY KEY (fecha, empleado, inicio)
+) WITHOUT ROWID;
+"""
+
+
+def _db_connect(db_path):
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.execute('PRAGMA foreign_keys = ON')
+    conn.executescript(DIRECTORIO_SCHEMA)
+    return conn
+
+
+def _db_value(val):
+    # nif y código se guardan con su tipo (int, float o texto) para escribirlos igual
+    return val if val is None or isinstance(val, (int, float, str)) else str(val)
+
+
+def load_directorio(conn, clave):
+    fila = conn.execute('SELECT cols, con_nif, con_codigo FROM plantillas WHERE clave = ?', (clave,)).fetchone()
+    if fila is None:
+        return None
+    cols, con_nif, con_codigo = fila
+    emps = [{'nombre': nombre, 'nombre_norm': _intern(norm), 'nif': nif, 'codigo': codigo}
+            for nombre, norm, nif, codigo in conn.execute(
+                'SELECT nombre, nombre_norm, nif, codigo FROM empleados WHERE clave = ? ORDER BY pos', (clave,))]
+    directorio = build_directorio(emps, bool(con_nif), bool(con_codigo))
+    directorio['cols'] = json.loads(cols)
+    with conn:
+        conn.execute('UPDATE plantillas SET usada = ? WHERE clave = ?', (datetime.now().timestamp(), clave))
+    return directorio
+
+
+def save_directorio(conn, clave, directorio):
+    cols = directorio['cols']
+    with conn:
+        conn.execute('DELETE FROM plantillas WHERE clave = ?', (clave,))
+        conn.execute('INSERT INTO plantillas VALUES (?, ?, ?, ?, ?)',
+                     (clave, json.dumps(cols), 'nif' in cols, 'codigo' in cols, datetime.now().timestamp()))
+        conn.executemany('INSERT INTO empleados VALUES (?, ?, ?, ?, ?, ?)', (
+            (clave, pos, pe['nombre'], pe['nombre_norm'], _db_value(pe['nif']), _db_value(pe['codigo']))
+            for pos, pe in enumerate(directorio['empleados'])))
+        # Solo se conservan las plantillas usadas más recientemente
+        conn.execute('DELETE FROM plantillas WHERE clave NOT IN '
+                     '(SELECT clave FROM plantillas ORDER BY usada DESC LIMIT ?)', (DIRECTORIO_DB_MAX_PLANTILLAS,))
+
+
+def load_alias(conn, directorio):
+    # Las asignaciones valen para cualquier versión de la plantilla: el empleado
+    # se vuelve a localizar por nif, código o nombre en el directorio actual
+    alias = {}
+    for nombre_norm, emp_nombre, emp_nif, emp_codigo in conn.execute(
+            'SELECT nombre_norm, emp_nombre, emp_nif, emp_codigo FROM alias'):
+        found = (directorio['por_nif'].get(normalize_id(emp_nif))
+                 or directorio['por_codigo'].get(normalize_id(emp_codigo))
+                 or directorio['index'].get(normalize_name(emp_nombre)))
+        if found is not None:
+            alias[nombre_norm] = found
+    return alias
+
+
+def save_alias(asignaciones, db_path=DIRECTORIO_DB):
+    # `asignaciones`: [(nombre tal cual aparece en los tramos, empleado del directorio)]
+    with closing(_db_connect(db_path)) as conn, conn:
+        conn.executemany('INSERT OR REPLACE INTO alias VALUES (?, ?, ?, ?, ?, ?)', (
+            (normalize_name(nombre), nombre, pe['nombre'], _db_value(pe['nif']), _db_value(pe['codigo']),
+             datetime.now().isoformat(timespec='seconds'))
+            for nombre, pe in asignaciones))
+
+
+def parse_directorio_persistente(plantilla_bytes, db_path=DIRECTORIO_DB):
+    # Misma salida que parse_directorio, pero la lectura de la plantilla solo se
+    # hace la primera vez que se ve ese contenido
+    clave = f'{DIRECTORIO_DB_VERSION}:{content_hash(plantilla_bytes)}'
+    with closing(_db_connect(db_path)) as conn:
+        directorio = load_directorio(conn, clave)
+        if directorio is None:
+            directorio, err = parse_directorio(plantilla_bytes)
+            if err:
+                return None, err
+            save_directorio(conn, clave, directorio)
+        directorio['alias'] = load_alias(conn, directorio)
+    return directorio, None
+
+
+# ═══════════════════════════════════════════════════
+# Exportación por diferencias (delta)
+# ═══════════════════════════════════════════════════
+
+# Lo ya importado en Endalia se reconoce por una huella de 8 bytes por tramo,
+# indexada por (empleado, fecha, inicio). Los tramos de un empleado que empiezan
+# a la vez comparten clave: se guardan las huellas de todos, ordenadas, y el grupo
+# entero se vuelve a exportar si cambia cualquiera de ellos. El origen de las
+# huellas es el almacén SQLite (lo que se ha descargado antes) o una salida
+# generada anteriormente
+DELTA_ORIGENES = {
+    'almacen': "Respecto a lo ya descargado",
+    'salida': "Respecto a una salida anterior",
+}
+DELTA_RETENCION_DIAS = 120
+
+
+def _minuto(val):
+    # Las fechas leídas de Excel arrastran ruido de coma flotante: se redondean al minuto
+    if not isinstance(val, datetime):
+        return None
+    return (val + timedelta(seconds=30)).replace(second=0, microsecond=0)
+
+
+def _clave_tramo(nif, codigo, nombre, fecha, inicio):
+    nif, codigo = normalize_id(nif), normalize_id(codigo)
+    empleado = f'n:{nif}' if nif else f'c:{codigo}' if codigo else f'e:{normalize_name(nombre)}'
+    return empleado, fecha.isoformat(), _minuto(inicio).isoformat(timespec='minutes')
+
+
+def _huella(fin, tipo_tramo, zona, sobrescritura):
+    fin = _minuto(fin)
+    texto = '\x1f'.join([fin.isoformat(timespec='minutes') if fin else '', str(tipo_tramo or ''), str(zona or ''),
+                         str(sobrescritura or '')])
+    return hashlib.blake2b(texto.encode('utf-8'), digest_size=8).digest()
+
+
+def _clave_registro(r, cols):
+    # Solo cuentan el nif y el código que la plantilla escribe (`cols`), igual que al
+    # leer una salida anterior
+    return _clave_tramo(r.nif if 'nif' in cols else None, r.codigo if 'codigo' in cols else None, r.nombre,
+                        r.fecha_ref, r.inicio)
+
+
+def _huella_registro(r, cols):
+    # Como en _clave_registro: los campos que la plantilla no tiene no se escriben
+    # y tampoco cuentan en la huella
+    return _huella(*(getattr(r, key) if key in cols else None
+                     for key in ('fin', 'tipo_tramo', 'zona', 'sobrescritura')))
+
+
+def _huellas_grupos(grupos):
+    # {clave: [huella de cada tramo]} -> {clave: huellas del grupo, ordenadas y concatenadas}
+    return {clave: b''.join(sorted(huellas)) for clave, huellas in grupos.items()}
+
+
+def _claves_huellas(output_rows, cols):
+    # (clave de cada fila, huellas por clave). Las filas sin fecha o sin inicio no se
+    # pueden identificar: no tienen clave ni huella
+    claves = [_clave_registro(r, cols) if r.fecha_ref is not None and isinstance(r.inicio, datetime) else None
+              for r in output_rows]
+    grupos = {}
+    for r, clave in zip(output_rows, claves):
+        if clave is not None:
+            grupos.setdefault(clave, []).append(_huella_registro(r, cols))
+    return claves, _huellas_grupos(grupos)
+
+
+def huellas_registros(output_rows, cols):
+    return _claves_huellas(output_rows, cols)[1]
+
+
+def filtrar_delta(output_rows, huellas, cols):
+    # Devuelve (filas nuevas o cambiadas, cuántas ya estaban exportadas tal cual)
+    claves, actuales = _claves_huellas(output_rows, cols)
+    filas = [r for r, clave in zip(output_rows, claves)
+             if clave is None or huellas.get(clave) != actuales[clave]]
+    return filas, len(output_rows) - len(filas)
+
+
+def huellas_delta(delta, fechas):
+    origen, dato = delta
+    if origen == 'salida':
+        return dato
+    # Del almacén solo hace falta el rango de fechas de esta exportación
+    dias = [d for d in fechas['fecha'] if d is not None]
+    return load_huellas(min(dias), max(dias), dato) if dias else {}
+
+
+def load_huellas(desde, hasta, db_path=DIRECTORIO_DB):
+    with closing(_db_connect(db_path)) as conn:
+        return {(empleado, fecha, inicio): huella for fecha, empleado, inicio, huella in conn.execute(
+            'SELECT fecha, empleado, inicio, huella FROM exportados WHERE fecha BETWEEN ? AND ?',
+            (desde.isoformat(), hasta.isoformat()))}
+
+
+def save_huellas(output_rows, cols, db_path=DIRECTORIO_DB):
+    # Caducan las huellas que llevan DELTA_RETENCION_DIAS sin volver a exportarse,
+    # sea cual sea la fecha del tramo
+    ahora = datetime.now()
+    caducan = (ahora - timedelta(days=DELTA_RETENCION_DIAS)).isoformat(timespec='seconds')
+    with closing(_db_connect(db_path)) as conn, conn:
+        conn.executemany('INSERT OR REPLACE INTO exportados VALUES (?, ?, ?, ?, ?)', (
+            (fecha, empleado, inicio, huella, ahora.isoformat(timespec='seconds'))
+            for (empleado, fecha, inicio), huella in huellas_registros(output_rows, cols).items()))
+        conn.execute('DELETE FROM exportados WHERE exportado < ?', (caducan,))
+
+
+def huellas_de_salida(salida_bytes):
+    # Huellas de una salida generada antes: una plantilla .xlsx o el .zip de partes
+    try:
+        with ZipFile(BytesIO(salida_bytes)) as zf:
+            if '[Content_Types].xml' in zf.namelist():
+                libros = [salida_bytes]
+            else:
+                libros = [zf.read(name) for name in zf.namelist() if name.endswith('.xlsx')]
+    except BadZipFile:
+        return None, "La salida anterior no es una plantilla .xlsx ni un .zip de plantillas."
+    grupos = {}
+    for libro in libros:
+        wb = openpyxl.load_workbook(BytesIO(libro), read_only=True, data_only=True)
+        try:
+            ws = get_template_sheet(wb)
+            cols = find_plantilla_columns(ws)
+            if 'empleado' not in cols or 'inicio' not in cols:
+                return None, "La salida anterior no tiene las columnas de la plantilla de Endalia."
+            idx = {key: col - 1 for key, col in cols.items()}
+            for values in ws.iter_rows(min_row=HEADER_ROW + 1, values_only=True):
+                campo = {key: values[i] if i < len(values) else None for key, i in idx.items()}
+                fecha = extract_date_part(campo.get('fecha_ref'))
+                if fecha is None or not isinstance(campo['inicio'], datetime):
+                    continue
+                clave = _clave_tramo(campo.get('nif'), campo.get('codigo'), campo['empleado'], fecha, campo['inicio'])
+                grupos.setdefault(clave, []).append(_huella(campo.get('fin'), campo.get('tipo_tramo'),
+                                                            campo.get('zona'), campo.get('sobrescritura')))
+        finally:
+            wb.close()
+    return _huellas_grupos(grupos), None
+
+
+# ═══════════════════════════════════════════════════
+# Caché compartida entre sesiones
+# ═══════════════════════════════════════════════════
+
+CACHE_MAX_ENTRIES = 64
+CACHE_MAX_BYTES = int(float(os.environ.get('ENDALIA_CACHE_MB', '512')) * 2 ** 20)
+CACHE_TTL_SECONDS = 30 * 60
+
+# Memoria aproximada de cada elemento que retiene una entrada de la caché. Son
+# estimaciones medidas con tracemalloc (CPython 3.11, 64 bits) sobre plantillas
+# y exportaciones sintéticas: bastan para que ENDALIA_CACHE_MB acote la memoria
+# del servidor, no para contarla al byte
+BYTES_POR_EMPLEADO = 940  # entrada del directorio y sus índices por nombre, palabras, NIF y código
+BYTES_POR_NGRAMA = 16  # cada aparición de un empleado en el índice de n-gramas
+BYTES_POR_TRAMO = 210  # Tramo pendiente con sus valores
+BYTES_POR_CERRADO = 190  # horario de un tramo que ya tenía hora fin
+BYTES_POR_HUELLA = 320
+BYTES_POR_FILA_PLANTILLA = 140  # cada fila vacía de la plantilla, aparte de su XML
+BYTES_POR_REGISTRO = 190  # Registro de salida y su posición en estado['fila_de']
+BYTES_POR_FECHA = 185  # fecha, inicio y fin interpretados de cada tramo
+BYTES_POR_INCIDENCIA = 545
+BYTES_POR_INTERVALO = 360  # intervalo de contexto_cerrados
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class CacheCompartida:
+    # LRU del proceso, indexada por hash del contenido: varias sesiones que suben
+    # los mismos archivos comparten un único parseo. Los valores se comparten tal
+    # cual, así que nadie debe modificarlos. El tamaño de cada entrada es una
+    # estimación de la memoria que retiene (ver tamano_entrada y tamano_resultado)
+    _FALTA = object()
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SECONDS):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.aciertos = 0
+        self.fallos = 0
+        self.expulsiones = 0
+        self._entradas = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._calculando = {}  # clave -> Lock: cada valor lo calcula una sola sesión
+
+    def _buscar(self, clave, now):
+        entrada = self._entradas.get(clave)
+        if entrada is None:
+            return self._FALTA
+        if now - entrada['ts'] > entrada['ttl']:
+            self._quitar(clave)
+            return self._FALTA
+        self._entradas.move_to_end(clave)
+        entrada['ts'] = now
+        return entrada['valor']
+
+    def _quitar(self, clave):
+        self._bytes -= self._entradas.pop(clave)['size']
+
+    def _expulsar(self, now):
+        for clave in [k for k, e in self._entradas.items() if now - e['ts'] > e['ttl']]:
+            self._quitar(clave)
+            self.expulsiones += 1
+        while self._entradas and (len(self._entradas) > self.max_entries or self._bytes > self.max_bytes):
+            self._quitar(next(iter(self._entradas)))
+            self.expulsiones += 1
+
+    def obtener(self, clave, default=None):
+        with self._lock:
+            valor = self._buscar(clave, monotonic())
+            if valor is self._FALTA:
+                self.fallos += 1
+                return default
+            self.aciertos += 1
+            return valor
+
+    def guardar(self, clave, valor, size, ttl=None):
+        with self._lock:
+            if clave in self._entradas:
+                self._quitar(clave)
+            if size > self.max_bytes:
+                # No cabría ni sola: guardarla solo serviría para vaciar la caché
+                self.expulsiones += 1
+                return
+            now = monotonic()
+            self._entradas[clave] = {'valor': valor, 'size': size, 'ts': now, 'ttl': ttl or self.ttl}
+            self._bytes += size
+            self._expulsar(now)
+
+    def obtener_o_calcular(self, clave, calcular, tamano, ttl=None):
+        # `tamano(valor)` estima la memoria del valor una vez calculado
+        with self._lock:
+            valor = self._buscar(clave, monotonic())
+            if valor is not self._FALTA:
+                self.aciertos += 1
+                return valor
+            calculo = self._calculando.setdefault(clave, threading.Lock())
+        # Si otra sesión ya lo está calculando, se espera a su resultado
+        with calculo:
+            with self._lock:
+                valor = self._buscar(clave, monotonic())
+                if valor is not self._FALTA:
+                    self.aciertos += 1
+                    return valor
+                self.fallos += 1
+            try:
+                valor = calcular()
+                self.guardar(clave, valor, tamano(valor), ttl)
+            finally:
+                with self._lock:
+                    self._calculando.pop(clave, None)
+        return valor
+
+    def invalidar(self, hash_):
+        # Quita toda entrada cuya clave incluya ese hash de contenido
+        with self._lock:
+            for clave in [k for k in self._entradas if hash_ in k]:
+                self._quitar(clave)
+
+    def estadisticas(self):
+        with self._lock:
+            return {'entradas': len(self._entradas), 'bytes': self._bytes, 'aciertos': self.aciertos,
+                    'fallos': self.fallos, 'expulsiones': self.expulsiones}
+
+
+def tamano_directorio(directorio):
+    return (len(directorio['empleados']) * BYTES_POR_EMPLEADO
+            + sum(map(len, directorio['ngramas'].values())) * BYTES_POR_NGRAMA)
+
+
+def tamano_tramos(parsed):
+    return (len(parsed['pendientes']) * BYTES_POR_TRAMO
+            + sum(map(len, parsed['cerrados'].values())) * BYTES_POR_CERRADO
+            + int(parsed['tabla'].memory_usage(deep=True).sum()))
+
+
+def tamano_prep(prep):
+    # La plantilla original, que se conserva, más su XML ya troceado
+    return (len(prep['template_bytes']) + len(prep['prefix']) + len(prep['header_rows']) + len(prep['suffix'])
+            + sum(len(xml) + BYTES_POR_FILA_PLANTILLA for _, xml in prep['blank_rows'])
+            + sum(map(len, prep['replace'].values())))
+
+
+def tamano_huellas(huellas):
+    return len(huellas) * BYTES_POR_HUELLA
+
+
+TAMANOS = {
+    'plantilla': tamano_directorio,
+    'tramos': tamano_tramos,
+    'prep': tamano_prep,
+    'huellas': tamano_huellas,
+}
+
+
+def tamano_entrada(kind, resultado):
+    # Los parsers devuelven (valor, error); un error no retiene casi nada
+    valor, _ = resultado
+    return TAMANOS[kind](valor) if valor is not None else 0
+
+
+def tamano_resultado(res):
+    # Todo lo que retiene una generación guardada: filas, incidencias, resumen,
+    # la salida si el spool sigue en memoria y el estado para regenerar
+    salida = res['salida'].seek(0, os.SEEK_END)
+    size = (len(res['rows']) * BYTES_POR_REGISTRO + len(res['incidencias']) * BYTES_POR_INCIDENCIA
+            + (salida if salida <= SPOOL_MAX_BYTES else 0)
+            + int(res['resumen']['tabla'].memory_usage(deep=True).sum()))
+    estado = res['estado']
+    if estado is not None:
+        size += len(estado['fechas']['fecha']) * BYTES_POR_FECHA
+        size += sum(len(inicios) for inicios, _ in estado['contexto'].values()) * BYTES_POR_INTERVALO
+        if estado['chunks'] is not None:
+            size += sum(len(segmento) for _, _, segmento in estado['chunks'])
+    return size
+
+
+def horas_hash(horas):
+    return content_hash(repr(sorted(horas.items())).encode())
@@ -0,0 +1,184 @@
+import random
+import xml.etree.ElementTree as ET
+import zlib
+from datetime import time
+from io import BytesIO
+from zipfile import ZipFile, ZIP_DEFLATED
+
+import openpyxl
+import pytest
+
+import bench
+import endalia
+
+NS = '{' + endalia.SPREADSHEET_NS + '}'
+N_EMPLEADOS = 50
+N_TRAMOS = 5 * endalia.WRITE_CHUNK_ROWS // 2  # varios bloques, el último incompleto
+
+# Validación de lista de la extensión x14 (la que openpyxl descarta) y un prefijo
+# declarado en la raíz que la salida de openpyxl no tiene
+EXT_LST = (
+    b'<extLst><ext uri="{CCE6A557-97BC-4b89-ADB6-D9C93CAAB3DF}" '
+    b'xmlns:x14="http://schemas.microsoft.com/office/spreadsheetml/2009/9/main">'
+    b'<x14:dataValidations count="1" xmlns:xm="http://schemas.microsoft.com/office/excel/2006/main">'
+    b'<x14:dataValidation type="list" allowBlank="1"><x14:formula1><xm:f>Listas!$A$1:$A$3</xm:f>'
+    b'</x14:formula1><xm:sqref>H2:H51</xm:sqref></x14:dataValidation></x14:dataValidations></ext></extLst>'
+)
+X14AC = b' xmlns:x14ac="http://schemas.microsoft.com/office/spreadsheetml/2009/9/ac"'
+
+# openpyxl avisa al leer la plantilla de que descarta la extensión x14
+pytestmark = pytest.mark.filterwarnings('ignore:Data Validation extension')
+
+
+# ═══════════════════════════════════════════════════
+# Datos
+# ═══════════════════════════════════════════════════
+
+def _miembros(zip_bytes):
+    with ZipFile(BytesIO(zip_bytes)) as zf:
+        assert zf.testzip() is None
+        return {name: zf.read(name) for name in zf.namelist()}
+
+
+@pytest.fixture(scope='module')
+def plantilla():
+    # Plantilla sintética de bench con extLst al final de la hoja
+    plantilla_bytes, nombres = bench.generar_plantilla(N_EMPLEADOS)
+    with ZipFile(BytesIO(plantilla_bytes)) as zf:
+        hoja = endalia.find_template_parts(zf)['sheet']
+        miembros = {info: zf.read(info) for info in zf.infolist()}
+    buf = BytesIO()
+    with ZipFile(buf, 'w', ZIP_DEFLATED) as zf:
+        for info, data in miembros.items():
+            if info.filename == hoja:
+                data = data.replace(b'<worksheet ', b'<worksheet' + X14AC + b' ', 1)
+                data = data.replace(b'</worksheet>', EXT_LST + b'</worksheet>')
+            zf.writestr(info, data)
+    return buf.getvalue(), hoja, nombres
+
+
+@pytest.fixture(scope='module')
+def pendientes(plantilla):
+    parsed, err = endalia.parse_tramos_pendientes(bench.generar_tramos(N_TRAMOS, plantilla[2]))
+    assert err is None
+    return parsed
+
+
+# ═══════════════════════════════════════════════════
+# Escritura directa del zip
+# ═══════════════════════════════════════════════════
+
+def test_crc32_combine():
+    rnd = random.Random(0)
+    for _ in range(50):
+        a = rnd.randbytes(rnd.randrange(100))
+        b = rnd.randbytes(rnd.choice([0, 1, rnd.randrange(5000)]))
+        assert endalia.crc32_combine(zlib.crc32(a), zlib.crc32(b), len(b)) == zlib.crc32(a + b)
+
+
+def test_regeneracion_igual_que_generacion_completa(plantilla, pendientes):
+    plantilla_bytes, _, _ = plantilla
+    directorio, err = endalia.parse_directorio(plantilla_bytes)
+    assert err is None
+    pend = pendientes['pendientes']
+    horas = {i: time(17, 0) for i in range(len(pend))}
+    resultado, err = endalia.generar_plantilla([t.con_hora_fin(h) for t, h in zip(pend, horas.values())],
+                                               plantilla_bytes, directorio, incremental=True,
+                                               cerrados=pendientes['cerrados'])
+    assert err is None and resultado['estado']['chunks'] is not None
+    rnd = random.Random(1)
+    for _ in range(3):
+        # Horas válidas, vacías y no válidas, repartidas por varios bloques
+        cambios_h = {rnd.randrange(len(pend)): rnd.choice([time(18, 30), None, '25:00', '19:15'])
+                     for _ in range(10)}
+        horas.update(cambios_h)
+        resultado, err = endalia.regenerar_plantilla(
+            resultado, {i: pend[i].con_hora_fin(h) for i, h in cambios_h.items()})
+        assert err is None
+        completa, err = endalia.generar_plantilla([pend[i].con_hora_fin(h) for i, h in horas.items()],
+                                                  plantilla_bytes, directorio, cerrados=pendientes['cerrados'])
+        assert err is None
+        assert _miembros(endalia.leer_salida(resultado['salida'])) == \
+            _miembros(endalia.leer_salida(completa['salida']))
+
+
+def test_copy_member_raw(plantilla):
+    plantilla_bytes, _, _ = plantilla
+    buf = BytesIO()
+    with ZipFile(BytesIO(plantilla_bytes)) as src, ZipFile(buf, 'w', ZIP_DEFLATED) as dst:
+        for info in src.infolist():
+            endalia.copy_member_raw(src, dst, info)
+    assert _miembros(buf.getvalue()) == _miembros(plantilla_bytes)
+
+
+# ═══════════════════════════════════════════════════
+# Parcheo de validaciones en streaming
+# ═══════════════════════════════════════════════════
+
+def _patch_zip_et(output_bytes, original_bytes):
+    # El parcheo original con ElementTree (árbol completo de cada hoja), como referencia
+    original_zip = ZipFile(BytesIO(original_bytes))
+    output_zip = ZipFile(BytesIO(output_bytes))
+    original_sheets = {name: original_zip.read(name) for name in original_zip.namelist()
+                       if name.startswith('xl/worksheets/') and name.endswith('.xml')}
+    result = {}
+    for item in output_zip.namelist():
+        data = output_zip.read(item)
+        if item in original_sheets:
+            output_tree = ET.fromstring(data)
+            original_tree = ET.fromstring(original_sheets[item])
+            for dv in output_tree.findall(NS + 'dataValidations'):
+                output_tree.remove(dv)
+            original_dv = original_tree.find(NS + 'dataValidations')
+            if original_dv is not None:
+                all_rows = output_tree.find(NS + 'sheetData').findall(NS + 'row')
+                if all_rows:
+                    max_row = max(int(r.get('r', '1')) for r in all_rows)
+                    for dv_item in original_dv.findall(NS + 'dataValidation'):
+                        dv_item.set('sqref', endalia.expand_sqref(dv_item.get('sqref', ''), max_row))
+                for tag in ('pageMargins', 'pageSetup', 'headerFooter', 'drawing', 'legacyDrawing', 'tableParts',
+                            'extLst'):
+                    target = output_tree.find(NS + tag)
+                    if target is not None:
+                        output_tree.insert(list(output_tree).index(target), original_dv)
+                        break
+                else:
+                    output_tree.append(original_dv)
+            original_ext = original_tree.find(NS + 'extLst')
+            if original_ext is not None:
+                for ext in output_tree.findall(NS + 'extLst'):
+                    output_tree.remove(ext)
+                output_tree.append(original_ext)
+            data = ET.tostring(output_tree)
+        result[item] = data
+    return result
+
+
+def _hoja(data):
+    raiz = ET.fromstring(data)
+    hijos = [hijo.tag for hijo in raiz]
+    partes = {tag: ET.canonicalize(ET.tostring(raiz.find(NS + tag)))
+              for tag in ('dataValidations', 'extLst') if raiz.find(NS + tag) is not None}
+    return hijos, partes
+
+
+def test_parcheo_streaming_igual_que_elementtree(plantilla):
+    plantilla_bytes, hoja, nombres = plantilla
+    # Salida como la del motor openpyxl: pierde extLst y no amplía las validaciones
+    wb = openpyxl.load_workbook(BytesIO(plantilla_bytes))
+    ws = wb[endalia.TEMPLATE_SHEET]
+    for i in range(3 * N_EMPLEADOS):
+        ws.cell(row=endalia.HEADER_ROW + 1 + i, column=3, value=nombres[i % len(nombres)])
+    buf = BytesIO()
+    wb.save(buf)
+    salida = buf.getvalue()
+    assert b'<extLst>' not in _miembros(salida)[hoja]
+
+    parcheada = _miembros(endalia.patch_zip_with_validations(salida, plantilla_bytes))
+    referencia = _patch_zip_et(salida, plantilla_bytes)
+    assert parcheada.keys() == referencia.keys()
+    hijos, partes = _hoja(parcheada[hoja])
+    assert (hijos, partes) == _hoja(referencia[hoja])
+    assert set(partes) == {'dataValidations', 'extLst'}
+    assert f'I2:I{endalia.HEADER_ROW + 3 * N_EMPLEADOS}' in partes['dataValidations']
+    assert X14AC.strip() in parcheada[hoja][:parcheada[hoja].index(b'<sheetData')]